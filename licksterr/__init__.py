@@ -5,15 +5,23 @@ import os
 from pathlib import Path
 
 from flask import Flask
+from sqlalchemy.exc import DBAPIError
 
-from licksterr.models import db, Form, Note
-from licksterr.queries import init_db
+from licksterr.export import export
+from licksterr.metrics import metrics, init_metrics
+from licksterr.models import db, Note
+from licksterr.profiling import profiling, init_profiling
 from licksterr.server import navigator
 from licksterr.song import song
+from licksterr.storage import configure_database
+from licksterr.util import MAX_CONTENT_LENGTH
 
 PROJECT_ROOT = Path(os.path.realpath(__file__)).parents[1]
 ASSETS_DIR = PROJECT_ROOT / "assets"
 
+logger = logging.getLogger(__name__)
+
+
 def setup_logging(path=os.path.join(ASSETS_DIR, 'logging.json'),
                   default_level=logging.INFO, env_key='LOG_CFG', to_file=True):
     """
@@ -44,13 +52,31 @@ def create_app(config=None):
     app.config.from_object(config if config else 'config')
     if not config:
         app.config.from_pyfile('config.py')
-    blueprints = (navigator, song)
+    # larger requests are answered with 413 before being read
+    app.config.setdefault('MAX_CONTENT_LENGTH', MAX_CONTENT_LENGTH)
+    blueprints = (navigator, song, metrics, profiling, export)
     for blueprint in blueprints:
         app.register_blueprint(blueprint)
+    init_metrics(app)
+    init_profiling(app)
     # Flask-SQLAlchemy
+    configure_database(app.config)
     app.app_context().push()
     db.init_app(app)
-    db.create_all()
-    if not len(Note.query.all()):
-        init_db()
+    check_database()
     return app
+
+
+def check_database():
+    """
+    Startup doesn't create the schema nor the notes and forms (see licksterr.migrations), it only warns if they're
+    missing. The note lookup table is loaded on first use.
+    """
+    try:
+        initialized = db.session.query(Note.query.exists()).scalar()
+    except DBAPIError:
+        db.session.rollback()
+        initialized = False
+    if not initialized:
+        logger.warning("The database is not initialized, run python -m licksterr.migrations")
+
@@ -1,19 +1,23 @@
 import hashlib
+import io
 import logging
 import os
 import struct
 from collections import defaultdict
-from fractions import Fraction
 from pathlib import Path
 
-import guitarpro as gp
 from mingus.core import notes
+from sqlalchemy.exc import DBAPIError
 
 from licksterr.exceptions import BadTabException
 from licksterr.key_finder import KeyFinder
-from licksterr.models import db, Song, Beat, Measure, Track, TrackMeasure
-from licksterr.util import timing
+from licksterr.metrics import STAGE_SECONDS
+from licksterr.profiling import profiled
+from licksterr.models import db, Song, Beat, Measure, NoteSet, Track, TrackMeasure
+from licksterr.storage import is_transient_error
+from licksterr.util import timing, lazy_import
 
+gp = lazy_import('guitarpro')
 logger = logging.getLogger(__name__)
 
 PROJECT_ROOT = Path(os.path.realpath(__file__)).parents[1]
@@ -21,13 +25,23 @@ ASSETS_DIR = PROJECT_ROOT / "assets"
 ANALYSIS_FOLDER = os.path.join(ASSETS_DIR, "analysis")
 
 KS_SECONDS = 1.5  # amount of seconds used to split segments in krumhansl-schmuckler alg
+KS_BATCH_SIZE = 500  # tracks whose keys are found together by redetect_keys
+INGESTION_ATTEMPTS = 3  # times an upload is analyzed before giving up on transient database errors
 
 
-def parse_song(filename, tracks=None):
-    try:
-        song = gp.parse(filename)
-    except struct.error:
-        raise BadTabException("Cannot open tab file.")
+def parse_song(filename, tracks=None, content=None, song=None):
+    """
+    Analyzes the tab, read from filename unless its content is given. The song already parsed from it can be given too.
+    """
+    if content is None:
+        with open(filename, mode='rb') as f:
+            content = f.read()
+    if song is None:
+        try:
+            with STAGE_SECONDS.labels('gp_parse').time():
+                song = gp.parse(io.BytesIO(content))
+        except struct.error:
+            raise BadTabException("Cannot open tab file.")
     data = {
         "album": song.album,
         "artist": song.artist,
@@ -36,12 +50,25 @@ def parse_song(filename, tracks=None):
         "year": song.copyright if song.copyright else None,
         "extension": filename[-3:]
     }
-    with open(filename, mode='rb') as f:
-        data['hash'] = str(hashlib.sha256(f.read()).digest()[:16])
-    s = Song.query.filter_by(hash=data['hash']).first()
-    if s:
-        logger.debug(f"Song with the same hash already found.")
-        return s
+    data['hash'] = str(hashlib.sha256(content).digest()[:16])
+    for attempt in range(1, INGESTION_ATTEMPTS + 1):
+        s = Song.query.filter_by(hash=data['hash']).first()
+        if s:
+            logger.debug(f"Song with the same hash already found.")
+            return s
+        try:
+            return store_song(song, data, tracks)
+        except DBAPIError as e:
+            db.session.rollback()
+            if attempt == INGESTION_ATTEMPTS or not is_transient_error(e):
+                raise
+            logger.warning(f"Analysis of {data['artist']} - {data['title']} failed ({e.orig}), retrying.")
+
+
+def store_song(song, data, tracks=None):
+    """Analyzes the chosen tracks of the parsed song and stores everything in a single transaction."""
+    # picks up the forms added since the last upload
+    NoteSet.sync_generation()
     s = Song(**data)
     logger.info(f"Parsing song {s}")
     for i, track in enumerate(song.tracks):
@@ -49,10 +76,12 @@ def parse_song(filename, tracks=None):
             t = parse_track(s, track, song.tempo)
             s.tracks.append(t)
     db.session.add(s)
-    db.session.commit()
+    with STAGE_SECONDS.labels('commit').time():
+        db.session.commit()
     return s
 
 
+@profiled
 @timing
 def parse_track(song, track, tempo):
     """
@@ -60,7 +89,7 @@ def parse_track(song, track, tempo):
     """
     logger.info(f"Parsing track {track.name}")
     tuning = [notes.note_to_int(str(string)[0]) for string in track.strings]
-    measure_match = defaultdict(list)  # measure: list of indexes the measure occupies in the track
+    measure_match = defaultdict(list)  # measure id: list of indexes the measure occupies in the track
     keyfinder = KeyFinder()
     note_durations = [0] * 12
     segment_duration = 0
@@ -70,33 +99,65 @@ def parse_track(song, track, tempo):
             beat = Beat.get_or_create(beat)
             beats.append(beat)
             # k-s analysis
-            beat_duration = Fraction(1 / beat.duration)
+            beat_duration = beat.ticks
             for note in beat.notes:
                 note_value = (tuning[note.string - 1] + note.fret) % 12
                 note_durations[note_value] += beat_duration
             # Does not increment segment duration if we had just pauses since now
             if any(duration for duration in note_durations):
                 segment_duration += beat_duration
-        measure = Measure.get_or_create(beats)
-        measure_match[measure].append(i)
+        measure_id = Measure.get_or_create(beats)
+        measure_match[measure_id].append(i)
         # k-s analysis
         # tempo is expressed in quarters per minute. When we reached a segment long enough, start key analysis
         # if segment_duration * 4 * 60 / tempo >= KS_SECONDS or m is track.measures[-1]:
         # Current implementation: make analysis at the end of each measure.
-        keyfinder.insert_durations(note_durations)
+        with STAGE_SECONDS.labels('key_finding').time():
+            keyfinder.insert_durations(note_durations)
         segment_duration = 0
         note_durations = [0] * 12
     # Updates database objects
-    track = Track(song_id=song.id, tuning=tuning, keys=[])
-    for measure, indexes in measure_match.items():
-        tm = TrackMeasure(track=track, measure=measure, match=len(track.measures), indexes=indexes)
+    track = Track(song_id=song.id, tuning=tuning, keys=[],
+                  histograms=KeyFinder.pack_histograms(keyfinder.get_histograms()))
+    for measure_id, indexes in measure_match.items():
+        tm = TrackMeasure(track=track, measure_id=measure_id, match=len(track.measures), indexes=indexes)
         db.session.add(tm)
     # Calculates matches of track against form given the keys
-    results = keyfinder.get_results()
+    with STAGE_SECONDS.labels('key_finding').time():
+        results = keyfinder.get_results()
     for k in set(results):
-        track.add_key(k)
+        track.add_key(k, timeline=False)
+    track.build_timeline()
+    track.build_form_vector()
     return track
 
 
+def redetect_keys(track_ids=None, batch_size=KS_BATCH_SIZE, **params):
+    """
+    Finds again the keys of the given tracks (the whole library if None) from their stored histograms, with the given
+    KeyFinder parameters. Tracks are processed in batches; the ones whose keys changed get their form matches
+    recomputed. Returns the keys found for each track.
+    """
+    results = {}
+    last_id = 0
+    while True:
+        query = Track.query.filter(Track.id > last_id, Track.histograms.isnot(None))
+        if track_ids is not None:
+            query = query.filter(Track.id.in_(track_ids))
+        tracks = query.order_by(Track.id).limit(batch_size).all()
+        if not tracks:
+            break
+        with STAGE_SECONDS.labels('key_finding').time():
+            keys = KeyFinder.find_keys([KeyFinder.unpack_histograms(track.histograms) for track in tracks], **params)
+        for track, track_keys in zip(tracks, keys):
+            if set(track_keys) != set(track.keys):
+                logger.debug(f"Keys of {track} changed from {track.keys} to {track_keys}")
+                track.set_keys(track_keys)
+            results[track.id] = track_keys
+        db.session.commit()
+        last_id = tracks[-1].id
+    return results
+
+
 if __name__ == '__main__':
     pass
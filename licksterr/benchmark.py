@@ -0,0 +1,42 @@
+"""
+Measures the cold start of the application: every run imports the package and creates the app in a new interpreter.
+Usage: python -m licksterr.benchmark [--runs N] [--config module]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+STARTUP_SCRIPT = """
+from time import perf_counter
+start = perf_counter()
+from licksterr import create_app
+imported = perf_counter()
+create_app({config})
+print(imported - start, perf_counter() - start)
+"""
+
+
+def measure_startup(config=None):
+    """Returns the seconds spent importing the package and the total seconds until the app is created."""
+    script = STARTUP_SCRIPT.format(config=repr(config))
+    output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    imported, total = output.split()[-2:]
+    return float(imported), float(total)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the time needed to import licksterr and create the app.")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--config', default=None, help="configuration object passed to create_app")
+    args = parser.parse_args()
+    runs = [measure_startup(args.config) for _ in range(args.runs)]
+    for name, values in zip(('import', 'create_app'), zip(*runs)):
+        values = [value * 1000 for value in values]
+        print(f"{name}: min {min(values):.0f}ms, median {statistics.median(values):.0f}ms, "
+              f"max {max(values):.0f}ms")
+
+
+if __name__ == '__main__':
+    main()
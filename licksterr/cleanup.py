@@ -0,0 +1,86 @@
+"""
+Deletes the measures and the beats that no track uses anymore, with their form matches and notes. Measures and beats
+are shared between songs, so deleting a song leaves behind the ones only that song used.
+Usage: python -m licksterr.cleanup [--batch-size N] [--interval SECONDS]
+"""
+import argparse
+import logging
+import time
+
+from sqlalchemy import exists
+
+from licksterr import setup_logging, create_app
+from licksterr.models import db, Measure, Beat, TrackMeasure, FormMeasure, MeasureBeat, BeatNote
+
+logger = logging.getLogger(__name__)
+
+ORPHAN_BATCH_SIZE = 1000
+
+
+def collect_orphans(batch_size=ORPHAN_BATCH_SIZE):
+    """Deletes all the orphan measures and then all the orphan beats. Returns how many of each were deleted."""
+    measures = beats = 0
+    while True:
+        deleted = collect_orphan_measures(batch_size)
+        measures += deleted
+        if deleted < batch_size:
+            break
+    while True:
+        deleted = collect_orphan_beats(batch_size)
+        beats += deleted
+        if deleted < batch_size:
+            break
+    logger.info(f"Deleted {measures} orphan measures and {beats} orphan beats.")
+    return measures, beats
+
+
+def collect_orphan_measures(batch_size=ORPHAN_BATCH_SIZE):
+    """
+    Deletes up to batch_size measures that no track uses, in a single transaction. On Postgres, the measures are
+    locked first and the ones an upload is reusing are skipped (see lock_for_reuse), since its new track_measure rows
+    aren't visible yet. On SQLite, uploads and the collection can't write at the same time.
+    """
+    ids = [row.id for row in db.session.query(Measure.id).filter(
+        ~exists().where(TrackMeasure.measure_id == Measure.id)).limit(batch_size).with_for_update(skip_locked=True)]
+    if not ids:
+        return 0
+    for model in (FormMeasure, MeasureBeat):
+        db.session.query(model).filter(model.measure_id.in_(ids), ~exists().where(
+            TrackMeasure.measure_id == model.measure_id)).delete(synchronize_session=False)
+    deleted = db.session.query(Measure).filter(Measure.id.in_(ids), ~exists().where(
+        TrackMeasure.measure_id == Measure.id)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def collect_orphan_beats(batch_size=ORPHAN_BATCH_SIZE):
+    """Deletes up to batch_size beats that no measure uses, in a single transaction, skipping the ones being reused."""
+    ids = [row.id for row in db.session.query(Beat.id).filter(
+        ~exists().where(MeasureBeat.beat_id == Beat.id)).limit(batch_size).with_for_update(skip_locked=True)]
+    if not ids:
+        return 0
+    db.session.query(BeatNote).filter(BeatNote.beat_id.in_(ids), ~exists().where(
+        MeasureBeat.beat_id == BeatNote.beat_id)).delete(synchronize_session=False)
+    deleted = db.session.query(Beat).filter(Beat.id.in_(ids), ~exists().where(
+        MeasureBeat.beat_id == Beat.id)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deletes the measures and beats that no track uses.")
+    parser.add_argument('--batch-size', type=int, default=ORPHAN_BATCH_SIZE, help="rows deleted per transaction")
+    parser.add_argument('--interval', type=float, default=None,
+                        help="keep running, collecting the orphans every INTERVAL seconds")
+    args = parser.parse_args()
+    setup_logging(to_file=False)
+    create_app()
+    while True:
+        collect_orphans(args.batch_size)
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
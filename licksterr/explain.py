@@ -0,0 +1,97 @@
+"""
+Runs EXPLAIN on the standard queries of the application against a seeded database and flags the ones that still need
+a sequential scan. Usage: python -m licksterr.explain [--natural]
+"""
+import argparse
+import json
+import logging
+import sys
+
+from sqlalchemy import text
+
+from licksterr import setup_logging, create_app
+from licksterr.models import db
+
+logger = logging.getLogger(__name__)
+
+# name: (query, query sampling its parameters from the database)
+STANDARD_QUERIES = {
+    'FormMeasure.get_forms': (
+        "SELECT form_id, measure_id, match FROM form_measure WHERE measure_id = :measure_id",
+        "SELECT measure_id FROM form_measure LIMIT 1"),
+    'TrackMeasure.get_measures': (
+        "SELECT * FROM track_measure WHERE track_id = :track_id",
+        "SELECT track_id FROM track_measure LIMIT 1"),
+    'TrackForm.get_forms': (
+        "SELECT * FROM track_form WHERE track_id = :track_id",
+        "SELECT track_id FROM track_form LIMIT 1"),
+    'Measure.to_dict': (
+        "SELECT * FROM measure_beat WHERE measure_id = :measure_id",
+        "SELECT measure_id FROM measure_beat LIMIT 1"),
+    'Note.get': (
+        "SELECT id FROM note WHERE string = :string AND fret = :fret AND muted = :muted",
+        "SELECT string, fret, muted FROM note LIMIT 1"),
+    'Note.forms': (
+        "SELECT form_id FROM form_note WHERE note_id = :note_id",
+        "SELECT note_id FROM form_note LIMIT 1"),
+    'Form.get': (
+        "SELECT id FROM form WHERE key = :key AND scale = :scale AND name = :name",
+        "SELECT key, scale, name FROM form LIMIT 1"),
+}
+
+
+def explain(query, params, natural=False):
+    """Returns the plan of the query as a list of lines and the list of tables that are scanned sequentially."""
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as connection:
+        if dialect == 'postgresql':
+            if not natural:
+                # Postgres prefers a sequential scan on small tables even when an index exists. With sequential scans
+                # disabled for this transaction, the ones left in the plan have no usable index.
+                connection.execute("SET LOCAL enable_seqscan = off")
+            plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), params).scalar()
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            lines, scans = [], []
+            walk_postgres_plan(plan[0]['Plan'], lines, scans)
+            return lines, scans
+        elif dialect == 'sqlite':
+            rows = connection.execute(text(f"EXPLAIN QUERY PLAN {query}"), params).fetchall()
+            lines = [row[-1] for row in rows]
+            # older versions of SQLite report 'SCAN TABLE name'
+            return lines, [line.replace('TABLE ', '').split()[1] for line in lines if line.startswith('SCAN')]
+        raise ValueError(f"EXPLAIN is not supported for {dialect}.")
+
+
+def walk_postgres_plan(node, lines, scans, depth=0):
+    relation = f" on {node['Relation Name']}" if 'Relation Name' in node else ''
+    index = f" using {node['Index Name']}" if 'Index Name' in node else ''
+    lines.append(f"{'  ' * depth}{node['Node Type']}{relation}{index}")
+    if node['Node Type'] == 'Seq Scan':
+        scans.append(node['Relation Name'])
+    for child in node.get('Plans', ()):
+        walk_postgres_plan(child, lines, scans, depth + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flags the standard queries that need a sequential scan.")
+    parser.add_argument('--natural', action='store_true',
+                        help="keep the planner settings untouched (on Postgres small tables are always scanned)")
+    args = parser.parse_args()
+    setup_logging(to_file=False)
+    create_app()
+    flagged = 0
+    for name, (query, sample) in STANDARD_QUERIES.items():
+        row = db.session.execute(text(sample)).first()
+        if not row:
+            print(f"{name}: skipped, no rows to sample parameters from")
+            continue
+        lines, scans = explain(query, dict(row.items()), natural=args.natural)
+        flagged += bool(scans)
+        print(f"{name}: {'SEQUENTIAL SCAN on ' + ', '.join(scans) if scans else 'ok'}")
+        for line in lines:
+            print(f"    {line}")
+    sys.exit(1 if flagged else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Exports the analysis results of the whole library, streaming them from a server-side cursor in batches of fixed size,
+so that memory stays bounded whatever the size of the library. The replica is used when one is configured.
+Formats: csv, or arrow (Arrow IPC stream) and parquet, which need the optional pyarrow package.
+Usage: python -m licksterr.export TABLE [--format FORMAT] [--output PATH] [--batch-size N]
+"""
+import argparse
+import csv
+import importlib.util
+import io
+import sys
+from enum import Enum
+
+from flask import Blueprint, Response, abort, current_app, request, stream_with_context
+from mingus.core import notes
+from sqlalchemy import select
+
+from licksterr.models import db, Form, KEYS, Track, TrackForm, TrackMeasure
+from licksterr.storage import REPLICA_BIND
+
+export = Blueprint('export', __name__)
+
+EXPORT_BATCH_SIZE = 10000
+FORMATS = {'csv': 'text/csv', 'arrow': 'application/vnd.apache.arrow.stream', 'parquet': 'application/octet-stream'}
+
+
+def explode_keys(row):
+    track_id, song_id, keys = row
+    for key in keys or ():
+        value, is_major = KEYS[key]
+        yield track_id, song_id, key, notes.int_to_note(value), is_major
+
+
+# name: (columns with their type, query, function turning a row of the query in rows of the export)
+EXPORTS = {
+    'track_form': (
+        (('track_id', 'int'), ('song_id', 'int'), ('form_id', 'int'), ('key', 'int'), ('scale', 'str'),
+         ('name', 'str'), ('match', 'float')),
+        select([TrackForm.track_id, Track.song_id, TrackForm.form_id, Form.key, Form.scale, Form.name, TrackForm.match])
+        .select_from(TrackForm.__table__.join(Track.__table__).join(Form.__table__))
+        .order_by(TrackForm.track_id, TrackForm.form_id),
+        lambda row: (tuple(row),)),
+    'track_measure': (
+        (('track_id', 'int'), ('measure_id', 'str'), ('match', 'float'), ('indexes', 'ints')),
+        select([TrackMeasure.track_id, TrackMeasure.measure_id, TrackMeasure.match, TrackMeasure.indexes])
+        .order_by(TrackMeasure.track_id, TrackMeasure.measure_id),
+        lambda row: (tuple(row),)),
+    'track_keys': (
+        (('track_id', 'int'), ('song_id', 'int'), ('key_id', 'int'), ('key', 'str'), ('is_major', 'bool')),
+        select([Track.id, Track.song_id, Track.keys]).order_by(Track.id),
+        explode_keys),
+}
+
+
+def get_engine():
+    """The replica if one is configured, so that exports don't load the primary."""
+    if REPLICA_BIND in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+        return db.get_engine(current_app, bind=REPLICA_BIND)
+    return db.engine
+
+
+def fetch_batches(table, batch_size=EXPORT_BATCH_SIZE):
+    """Yields the rows of the export in lists of about batch_size rows, reading them with a server-side cursor."""
+    _, query, explode = EXPORTS[table]
+    with get_engine().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [tuple(value.name if isinstance(value, Enum) else value for value in exploded)
+                   for row in rows for exploded in explode(row)]
+
+
+def write_csv(columns, batches):
+    stream = io.StringIO()
+    writer = csv.writer(stream)
+    writer.writerow(name for name, _ in columns)
+    lists = [i for i, (_, kind) in enumerate(columns) if kind == 'ints']
+    for rows in batches:
+        for row in rows:
+            if lists:
+                row = list(row)
+                for i in lists:
+                    row[i] = ' '.join(str(value) for value in row[i] or ())
+            writer.writerow(row)
+        yield stream.getvalue().encode()
+        stream.seek(0)
+        stream.truncate()
+    yield stream.getvalue().encode()
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what was written since the last drain, keeping the position for the writers."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def write_arrow(columns, batches, parquet=False):
+    import pyarrow as pa
+    types = {'int': pa.int64(), 'float': pa.float64(), 'str': pa.string(), 'bool': pa.bool_(),
+             'ints': pa.list_(pa.int32())}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+    sink = ChunkSink()
+    if parquet:
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    for rows in batches:
+        # tracks without keys explode to no rows
+        if not rows:
+            continue
+        arrays = [pa.array(list(values), type=schema.field(i).type) for i, values in enumerate(zip(*rows))]
+        table = pa.Table.from_arrays(arrays, schema=schema)
+        # a parquet row group or a record batch per fetched batch
+        if parquet:
+            writer.write_table(table)
+        else:
+            writer.write_table(table, max_chunksize=len(rows))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream_export(table, format='csv', batch_size=EXPORT_BATCH_SIZE):
+    """Yields the export of the table in the given format, chunk by chunk."""
+    if format != 'csv' and importlib.util.find_spec('pyarrow') is None:
+        raise ValueError(f"The {format} format needs pyarrow.")
+    columns = EXPORTS[table][0]
+    batches = fetch_batches(table, batch_size)
+    if format == 'csv':
+        return write_csv(columns, batches)
+    return write_arrow(columns, batches, parquet=format == 'parquet')
+
+
+@export.route('/export/<table>', methods=['GET'])
+def export_table(table):
+    format = request.args.get('format', 'csv')
+    if table not in EXPORTS or format not in FORMATS:
+        abort(404)
+    batch_size = request.args.get('batch_size', EXPORT_BATCH_SIZE, type=int)
+    if batch_size <= 0:
+        abort(400)
+    try:
+        chunks = stream_export(table, format, batch_size)
+    except ValueError:
+        abort(400)
+    return Response(stream_with_context(chunks), mimetype=FORMATS[format],
+                    headers={'Content-Disposition': f'attachment; filename={table}.{format}'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the analysis results of the whole library.")
+    parser.add_argument('table', choices=EXPORTS)
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--output', default=None, help="file to write, standard output if missing")
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+    if args.batch_size <= 0:
+        parser.error("--batch-size must be positive")
+    # the package imports this module through the export blueprint
+    from licksterr import setup_logging, create_app
+    setup_logging(to_file=False)
+    create_app()
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in stream_export(args.table, args.format, args.batch_size):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
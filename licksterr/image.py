@@ -1,27 +1,57 @@
+"""
+Draws scale charts on a blank fretboard. The charts of whole sets of tunings, keys, scales and forms are rendered in
+parallel, as separate files and/or as a single atlas image with a JSON index of the position of each chart:
+python -m licksterr.image [--tuning 4,11,7,2,9,4] [--keys C,G] [--scales Ionian,Dorian] [--forms CAGED] [--separate]
+                          [--output DIR] [--atlas] [--workers N]
+"""
+import argparse
+import json
+import logging
+import math
 import os
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
 
-from PIL import Image, ImageColor
+from PIL import Image, ImageColor, ImageDraw
+from mingus.core import notes
 
-from licksterr import ASSETS_DIR
-from licksterr.models import String, Form, STANDARD_TUNING
+from licksterr import ASSETS_DIR, setup_logging, create_app
+from licksterr.models import db, String, Form, FormNote, Note, NOTES_DICT, SCALES_DICT, STANDARD_TUNING
 from licksterr.util import timing
 
+logger = logging.getLogger(__name__)
+
+CHARTS_DIR = Path(ASSETS_DIR) / "analysis" / "scales"
+SCALE_NAMES = {scale: cls.__name__ for cls, scale in SCALES_DICT.items()}
+# name is the path of the chart without extension, positions the (string, fret) of its notes
+Chart = namedtuple('Chart', ('name', 'tuning', 'key', 'positions'))
+
 
 class GuitarImage:
     def __init__(self, tuning=STANDARD_TUNING):
-        self.strings = (None,) + tuple(String(note) for note in tuning[::-1])
+        # strings are numbered from the high E, as in the forms
+        self.tuning = tuple(tuning)
+        self.strings = (None,) + tuple(String(note) for note in self.tuning)
         self.im = Image.open(os.path.join(ASSETS_DIR, "blank_fret_board.png"))
+        self.im.load()
         # The open high E string circle is at (19,15). H step: 27px. V step: 16px. 22 frets total + open strings
         for i, string in enumerate(self.strings[1:]):
             string.positions = tuple((19 + j * 27, 15 + i * 16) for j in range(23))
 
     def fill_scale_position(self, key, scale, form, im=None):
-        # todo make color pattern for scale degrees customizable
-        im = im if im else self.im
+        """Draws the form on a copy of the blank fretboard, unless an image is given."""
         form = Form.get(key, scale, form)
-        for note in form.notes:
-            color = 'red' if note.fret in self.strings[note.string][form.key] else 'green'
-            self.fill_note(self.strings[note.string], note.fret, color=ImageColor.getcolor(color, 'RGBA'), im=im)
+        return self.fill_form([(note.string, note.fret) for note in form.notes], form.key, im=im)
+
+    def fill_form(self, positions, key, im=None):
+        # todo make color pattern for scale degrees customizable
+        im = im if im else self.im.copy()
+        root, other = (ImageColor.getcolor(color, 'RGBA') for color in ('red', 'green'))
+        for string, fret in positions:
+            color = root if (self.tuning[string - 1] + fret) % 12 == key else other
+            self.fill_note(self.strings[string], fret, color=color, im=im)
         return im
 
     @timing
@@ -49,17 +79,109 @@ class GuitarImage:
         color = color if color else ImageColor.getcolor('green', mode='RGBA')
         black = ImageColor.getcolor('black', mode='RGBA')
         im = im if im else self.im
-        pixel = im.getpixel(xy)
-        if pixel not in (black, color):  # skips if black or already filled
-            im.putpixel(xy, color)
-            for ij in (1, 0), (0, 1), (-1, 0), (0, -1):  # goes to adjacent pixels
-                new_xy = (xy[0] + ij[0], xy[1] + ij[1])
-                self.fill_circle(new_xy, color, im)
+        # skips black and already filled pixels
+        ImageDraw.floodfill(im, xy, color, border=black)
         return im
 
 
+def load_charts(tunings=(STANDARD_TUNING,), keys=range(12), scales=tuple(SCALE_NAMES), forms='CAGED',
+                separate=False):
+    """
+    Reads the notes of the forms in a single query and returns the charts to render: one per tuning, key and scale
+    with all the forms drawn together, or one per form if separate. Charts of other tunings than the standard one go
+    in a directory named after the tuning.
+    """
+    tunings = [tuple(tuning) for tuning in tunings]
+    query = db.session.query(Form.key, Form.scale, Form.name, Form.tuning, Note.string, Note.fret) \
+        .join(FormNote, FormNote.form_id == Form.id).join(Note, Note.id == FormNote.note_id) \
+        .filter(Form.key.in_(list(keys)), Form.scale.in_(list(scales)), Form.name.in_(list(forms))) \
+        .order_by(Form.key, Form.scale, Form.name)
+    positions = defaultdict(set)
+    for row in query:
+        tuning = tuple(row.tuning)
+        if tuning in tunings:
+            form = row.name if separate else None
+            positions[tuning, row.key, row.scale, form].add((row.string, row.fret))
+    charts = []
+    for (tuning, key, scale, form), form_positions in positions.items():
+        name = f"{SCALE_NAMES[scale]}/{notes.int_to_note(key)}" + (f"_{form}" if form else '')
+        if tuning != tuple(STANDARD_TUNING):
+            name = f"{'-'.join(notes.int_to_note(value) for value in tuning)}/{name}"
+        charts.append(Chart(name, tuning, key, tuple(sorted(form_positions))))
+    return sorted(charts)
+
+
+_GUITARS = {}  # fretboard of each tuning, loaded once per worker
+
+
+def render_chart(chart, output_dir=None, raw=False):
+    """Saves the chart in output_dir, if given. Returns the size and pixels of the chart if raw, otherwise None."""
+    if chart.tuning not in _GUITARS:
+        _GUITARS[chart.tuning] = GuitarImage(chart.tuning)
+    im = _GUITARS[chart.tuning].fill_form(chart.positions, chart.key)
+    if output_dir:
+        path = Path(output_dir) / f"{chart.name}.png"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        im.save(path)
+    return (im.size, im.tobytes()) if raw else None
+
+
+@timing
+def render_charts(charts, output_dir=None, atlas=None, workers=None):
+    """
+    Renders the charts across a pool of processes, saving them in output_dir if given. If atlas is a path, the charts
+    are also laid out in a grid saved there, with the index of the box of each chart next to it as a .json file.
+    Returns the index.
+    """
+    if not charts:
+        return {}
+    atlas_im = None
+    index = {}
+    columns = math.ceil(math.sqrt(len(charts)))
+    workers = workers or os.cpu_count()
+    render = partial(render_chart, output_dir=output_dir, raw=atlas is not None)
+    with ProcessPoolExecutor(workers) as executor:
+        for i, (chart, result) in enumerate(zip(charts, executor.map(render, charts,
+                                                                     chunksize=max(len(charts) // (workers * 4), 1)))):
+            if result is None:
+                continue
+            (width, height), pixels = result
+            if atlas_im is None:
+                atlas_im = Image.new('RGBA', (width * columns, height * math.ceil(len(charts) / columns)))
+            x, y = i % columns * width, i // columns * height
+            atlas_im.paste(Image.frombytes('RGBA', (width, height), pixels), (x, y))
+            index[chart.name] = {'x': x, 'y': y, 'width': width, 'height': height, 'tuning': list(chart.tuning),
+                                 'key': chart.key}
+    if atlas is not None:
+        atlas = Path(atlas)
+        atlas.parent.mkdir(parents=True, exist_ok=True)
+        atlas_im.save(atlas)
+        atlas.with_suffix('.json').write_text(json.dumps(index, indent=1))
+    logger.info(f"Rendered {len(charts)} charts with {workers} workers.")
+    return index
+
+
 def main():
-    pass
+    scale_names = {name: scale for scale, name in SCALE_NAMES.items()}
+    parser = argparse.ArgumentParser(description="Renders the scale charts.")
+    parser.add_argument('--tuning', action='append', type=lambda value: [int(v) for v in value.split(',')],
+                        help="notes of the strings from the high one, as integers (repeatable, default: standard)")
+    parser.add_argument('--keys', type=lambda value: [NOTES_DICT[key] for key in value.split(',')], default=range(12))
+    parser.add_argument('--scales', type=lambda value: [scale_names[scale] for scale in value.split(',')],
+                        default=tuple(SCALE_NAMES), help=f"any of {','.join(scale_names)}")
+    parser.add_argument('--forms', default='CAGED')
+    parser.add_argument('--separate', action='store_true', help="one chart per form instead of one per scale")
+    parser.add_argument('--output', type=Path, default=CHARTS_DIR)
+    parser.add_argument('--atlas', action='store_true', help="also lays out all the charts in atlas.png and atlas.json")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    setup_logging(to_file=False)
+    create_app()
+    charts = load_charts(args.tuning or [STANDARD_TUNING], args.keys, args.scales, args.forms, args.separate)
+    # workers inherit the connections of the pool, which they don't use
+    db.session.remove()
+    db.engine.dispose()
+    render_charts(charts, args.output, args.output / 'atlas.png' if args.atlas else None, args.workers)
 
 
 if __name__ == '__main__':
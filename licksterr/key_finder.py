@@ -1,6 +1,10 @@
 import logging
-from collections import deque, defaultdict
+from collections import defaultdict
+from functools import lru_cache
 
+from licksterr.util import lazy_import
+
+np = lazy_import('numpy')
 logger = logging.getLogger(__name__)
 
 
@@ -16,11 +20,13 @@ class KeyFinder:
     scores when the key is changed (it resembles the principle of inertia of a key, meaning that usually songs don't
     jump from one key to another , but tend to stay in a specific key for some time).
     Given n segments of 24 elements each (12+12 keys), the problem consists in finding the list of keys that maximizes
-    the scores. Since computing all the 24*n combinations is not feasible, a dynamic-programming approach is used: the
-    algorithm stores 24 linked lists, and at every iteration (insert_durations) the node with the highest score for each
-    pitch class is kept. In case of ties (two different nodes of the previous generations generated a node with the same
-    score for the same pitch class) the parent with the highest score keeps the children. The best match is the linked
-    list with the node that has the highest score.
+    the scores. Since computing all the 24*n combinations is not feasible, a dynamic-programming approach is used: at
+    every segment, for each of the 24 keys only the path with the highest score ending in that key is kept. In case of
+    ties (two different paths of the previous segment reach the same score for the same key) the path with the highest
+    score keeps the key. The best match is the path with the highest score at the last segment.
+    The pitch-class durations of every segment are kept (see get_histograms), so that the keys can be found again with
+    different parameters, and find_keys scores the segments of many tracks at once with a single product against the
+    profile matrix.
     More info at https://pdfs.semanticscholar.org/2633/fe61583a79ded19348516467971ce3aeb20a.pdf
     """
     MAJOR_PROFILES = (5.0, 2.0, 3.5, 2.0, 4.5, 4.0, 2.0, 4.5, 2.0, 3.5, 1.5, 4.0)
@@ -28,71 +34,74 @@ class KeyFinder:
     MODULATION_TOLERANCE = 0.15  # % of time a key has to be repeated to be considered a valid modulation
 
     def __init__(self, penalty=0.2, flat=True):
-        self.leaves = Node.new_generation()
         self.penalty = penalty
         self.flat = flat
+        self.histograms = []
 
     def get_results(self):
-        node = max(self.leaves, key=lambda node: node.score)
-        keys = defaultdict(float)
-        i = 0
-        while node.parent:
-            keys[node.key] += 1
-            node = node.parent
-            i += 1
-        return [k for k, v in keys.items() if v / i >= self.MODULATION_TOLERANCE]
+        return self.find_keys([self.get_histograms()], penalty=self.penalty, flat=self.flat)[0]
 
     def insert_durations(self, durations):
         if not any(durations):
             return
-        scores = self.get_segment_score(durations)
-        possible_children = defaultdict(list)  # {root: list of possible children for this node}
-        next_gen = Node.new_generation()
-        for root in self.leaves:
-            for j, score in enumerate(scores):
-                penalized_score = root.score + score * (1 if root.key == j else self.penalty)
-                if penalized_score > next_gen[j].score:
-                    next_gen[j] = Node(key=j, score=penalized_score)
-                if penalized_score >= next_gen[j].score:
-                    possible_children[root].append(next_gen[j])
-        for parent, children in possible_children.items():
-            for child in children:
-                # If the children has another parent, the parent with the highest score keeps the children
-                if child in next_gen and (not child.parent or child.parent.score < parent.score):
-                    child.parent = parent
-        self.leaves = next_gen
-
-    def get_segment_score(self, durations):
-        scores = [0] * 24
-        if self.flat:
-            durations = [1 if duration else 0 for duration in durations]
-        durations = deque(durations)
-        for i in range(12):
-            scores[i] += self.dot(durations, self.MAJOR_PROFILES)
-            scores[i + 12] += self.dot(durations, self.MINOR_PROFILES)
-            durations.rotate(-1)
-        return scores
+        self.histograms.append([float(duration) for duration in durations])
 
-    @staticmethod
-    def dot(l1, l2):
-        if len(l1) != len(l2):
-            return 0
-        return sum(i[0] * i[1] for i in zip(l1, l2))
+    def get_histograms(self):
+        return np.array(self.histograms, dtype=np.float32).reshape(-1, 12)
 
+    @classmethod
+    def get_scores(cls, histograms, flat=True):
+        if flat:
+            histograms = (histograms > 0).astype(np.float32)
+        return histograms @ cls.get_profile_matrix()
 
-class Node:
-    def __init__(self, key, score, **kwargs):
-        super().__init__(**kwargs)
-        self.key = key
-        self.score = round(score, 2)
-        self.parent = None
+    @classmethod
+    @lru_cache(maxsize=None)
+    def get_profile_matrix(cls):
+        """Column i holds the profile of key i for each of the 12 pitch classes."""
+        return np.stack([np.roll(profiles, i) for profiles in (cls.MAJOR_PROFILES, cls.MINOR_PROFILES)
+                         for i in range(12)], axis=1).astype(np.float32)
 
-    def __str__(self):
-        return f"{self.key} - {self.score}"
+    @classmethod
+    def find_keys(cls, histograms, penalty=0.2, flat=True):
+        """
+        Finds the keys of many tracks at once, given the list of their (segments x 12) histograms. The tracks are padded
+        to the same number of segments and advanced together through the dynamic-programming steps.
+        """
+        lengths = np.array([len(h) for h in histograms])
+        n_segments = lengths.max(initial=0)
+        if not n_segments:
+            return [[] for _ in histograms]
+        durations = np.zeros((len(histograms), n_segments, 12), dtype=np.float32)
+        for i, h in enumerate(histograms):
+            durations[i, :len(h)] = h
+        scores = cls.get_scores(durations, flat).astype(np.float64)
+        weights = np.full((24, 24), penalty)
+        np.fill_diagonal(weights, 1)
+        leaves = np.zeros((len(histograms), 24))
+        parents = np.zeros((len(histograms), n_segments, 24), dtype=np.int8)
+        for t in range(n_segments):
+            # candidates[track, previous key, key]
+            candidates = leaves[:, :, None] + scores[:, t, None, :] * weights
+            best = candidates.max(axis=1)
+            tied = candidates == best[:, None, :]
+            parents[:, t] = np.where(tied, leaves[:, :, None], -np.inf).argmax(axis=1)
+            active = (t < lengths)[:, None]
+            leaves = np.where(active, np.round(best, 2), leaves)
+        results = []
+        for i, length in enumerate(lengths):
+            keys = defaultdict(float)
+            key = leaves[i].argmax()
+            for t in range(length - 1, -1, -1):
+                keys[int(key)] += 1
+                key = parents[i, t, key]
+            results.append([k for k, v in keys.items() if v / length >= cls.MODULATION_TOLERANCE])
+        return results
 
-    def get_upwards_score(self):
-        return self.score + (self.parent.get_upwards_score() if self.parent else 0)
+    @staticmethod
+    def pack_histograms(histograms):
+        return np.asarray(histograms, dtype='<f4').tobytes()
 
-    @classmethod
-    def new_generation(cls, n=24):
-        return [cls(key=key, score=0) for key in range(n)]
+    @staticmethod
+    def unpack_histograms(blob):
+        return np.frombuffer(blob, dtype='<f4').reshape(-1, 12)
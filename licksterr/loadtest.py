@@ -0,0 +1,177 @@
+"""
+Drives the HTTP API of a running server with concurrent clients and reports throughput, latency percentiles and error
+rates for each operation. Uploads use the tabs in assets/tests and synthetic tabs generated from them.
+Usage: python -m licksterr.loadtest [--url URL] [--clients N] [--duration SECONDS] [--mix upload=1,track=10,...]
+"""
+import argparse
+import io
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import guitarpro as gp
+import requests
+
+from licksterr import ASSETS_DIR
+
+FIXTURES_DIR = ASSETS_DIR / "tests"
+BAD_FIXTURES = ('wrong_file.gp5',)
+DEFAULT_MIX = {'upload': 1, 'synthetic': 1, 'tabinfo': 2, 'track': 10, 'song': 5, 'index': 1}
+PERCENTILES = (50, 95, 99)
+
+
+class Library:
+    """Tabs to upload, and the ids of the songs and tracks on the server that reads are sampled from."""
+
+    def __init__(self, seed=0):
+        self.fixtures = {path.name: path.read_bytes() for path in sorted(FIXTURES_DIR.glob('*.gp5'))
+                         if path.name not in BAD_FIXTURES}
+        self.songs = []
+        self.tracks = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def fixture(self):
+        with self._lock:
+            name = self._random.choice(sorted(self.fixtures))
+        return name, self.fixtures[name]
+
+    def synthetic(self):
+        """Transposes every measure of a fixture by a random amount, so that the tab and most measures are new."""
+        name, content = self.fixture()
+        song = gp.parse(io.BytesIO(content))
+        with self._lock:
+            song.title = f"Synthetic {self._random.getrandbits(64):016x}"
+            shifts = [self._random.randrange(12) for _ in range(len(song.tracks[0].measures))]
+        for track in song.tracks:
+            for measure, shift in zip(track.measures, shifts):
+                for voice in measure.voices:
+                    for beat in voice.beats:
+                        for note in beat.notes:
+                            note.value = min(note.value + shift, 24)
+        stream = io.BytesIO()
+        gp.write(song, stream, version=song.versionTuple)
+        return f"synthetic-{name}", stream.getvalue()
+
+    def discover(self, session, url):
+        """Collects the ids of the songs on the server, and of their tracks, until the first missing one."""
+        song_id = 1
+        while True:
+            response = session.get(f"{url}/songs/{song_id}")
+            if response.status_code != 200:
+                break
+            self.songs.append(song_id)
+            self.tracks.extend(response.json()['tracks'])
+            song_id += 1
+
+    def sample(self, ids):
+        with self._lock:
+            return self._random.choice(ids) if ids else 1
+
+
+def upload(session, url, library, synthetic=False):
+    name, content = library.synthetic() if synthetic else library.fixture()
+    return session.post(f"{url}/upload", files={name: content}, data={'tracks': json.dumps([0])})
+
+
+OPERATIONS = {
+    'upload': lambda session, url, library: upload(session, url, library),
+    'synthetic': lambda session, url, library: upload(session, url, library, synthetic=True),
+    'tabinfo': lambda session, url, library: session.post(f"{url}/tabinfo", files=dict([library.fixture()])),
+    'track': lambda session, url, library: session.get(f"{url}/tracks/{library.sample(library.tracks)}"),
+    'song': lambda session, url, library: session.get(f"{url}/songs/{library.sample(library.songs)}"),
+    'index': lambda session, url, library: session.get(f"{url}/"),
+}
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds, ok):
+        with self._lock:
+            self.latencies[operation].append(seconds)
+            if not ok:
+                self.errors[operation] += 1
+
+    def report(self, elapsed):
+        lines = [f"{'operation':<10} {'requests':>8} {'req/s':>8} {'errors':>7} " +
+                 ' '.join(f"{'p' + str(p):>8}" for p in PERCENTILES)]
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        for operation in sorted(self.latencies):
+            latencies = sorted(self.latencies[operation])
+            errors = self.errors[operation] / len(latencies)
+            lines.append(f"{operation:<10} {len(latencies):>8} {len(latencies) / elapsed:>8.1f} {errors:>7.1%} " +
+                         ' '.join(f"{percentile(latencies, p) * 1000:>6.0f}ms" for p in PERCENTILES))
+        lines.append(f"{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s")
+        return '\n'.join(lines)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of the sorted values."""
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def client(url, library, mix, deadline, results, seed):
+    rng = random.Random(seed)
+    operations, weights = zip(*mix.items())
+    with requests.Session() as session:
+        while time.monotonic() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = OPERATIONS[operation](session, url, library).status_code < 400
+            except requests.RequestException:
+                ok = False
+            results.record(operation, time.perf_counter() - start, ok)
+
+
+def run(url, clients, duration, mix, seed=0):
+    library = Library(seed)
+    with requests.Session() as session:
+        # reads need at least a song on the server
+        upload(session, url, library)
+        library.discover(session, url)
+    results = Results()
+    deadline = time.monotonic() + duration
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        futures = [executor.submit(client, url, library, mix, deadline, results, seed + i + 1)
+                   for i in range(clients)]
+        for future in futures:
+            future.result()
+    return results, time.perf_counter() - start
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {operation}, choose from {', '.join(OPERATIONS)}.")
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the HTTP API of a running server.")
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--duration', type=float, default=30, help="seconds")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help=f"relative weight of each operation, default: "
+                             f"{','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items())}")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    results, elapsed = run(args.url.rstrip('/'), args.clients, args.duration, args.mix, args.seed)
+    print(results.report(elapsed))
+
+
+if __name__ == '__main__':
+    main()
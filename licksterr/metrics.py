@@ -0,0 +1,265 @@
+import logging
+import threading
+from functools import wraps
+from time import perf_counter
+
+from flask import Blueprint, Response, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+metrics = Blueprint('metrics', __name__)
+
+INF = float('inf')
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, INF)
+QUERY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, INF)
+
+
+class Registry:
+    """In-process collection of metrics, rendered with the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self.metrics[metric.name] = metric
+
+    def get(self, name):
+        return self.metrics.get(name)
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """
+    Base class for metrics. A metric with labels holds a child for every combination of label values, obtained with
+    labels(); a metric without labels can be used directly.
+    """
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self.labels()
+        registry.register(self)
+
+    def labels(self, *values):
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {values}.")
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self.new_child()
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def expose(self):
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            yield from child.expose(self.name, dict(zip(self.label_names, values)))
+
+    def __getattr__(self, item):
+        # Metrics without labels forward inc(), observe(), etc. to their only child
+        if item.startswith('_') or self.__dict__.get('label_names', True):
+            raise AttributeError(item)
+        return getattr(self.labels(), item)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+
+def format_value(value):
+    if value == INF:
+        return '+Inf'
+    return repr(float(value))
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("Counters can only be incremented.")
+        with self._lock:
+            self.value += amount
+
+    def expose(self, name, labels):
+        yield f"{name}{format_labels(labels)} {format_value(self.value)}"
+
+
+class GaugeChild(CounterChild):
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def track_inprogress(self, f):
+        @wraps(f)
+        def wrap(*args, **kw):
+            self.inc()
+            try:
+                return f(*args, **kw)
+            finally:
+                self.dec()
+
+        return wrap
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def time(self):
+        return Timer(self)
+
+    def expose(self, name, labels):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield f"{name}_bucket{format_labels({**labels, 'le': format_value(bound)})} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {format_value(total)}"
+        yield f"{name}_count{format_labels(labels)} {cumulative}"
+
+
+class Timer:
+    """Observes the elapsed seconds in a histogram. Can be used both as a context manager and as a decorator."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._start = threading.local()
+
+    def __enter__(self):
+        if not hasattr(self._start, 'stack'):
+            self._start.stack = []
+        self._start.stack.append(perf_counter())
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self._start.stack.pop())
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrap(*args, **kw):
+            with self:
+                return f(*args, **kw)
+
+        return wrap
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) if buckets[-1] == INF else tuple(sorted(buckets)) + (INF,)
+        super().__init__(name, documentation, labels=labels, registry=registry)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+
+STAGE_SECONDS = Histogram('licksterr_stage_seconds', "Time spent in each stage of the analysis pipeline.",
+                          labels=('stage',))
+REQUEST_SECONDS = Histogram('licksterr_request_seconds', "Time spent serving each endpoint.", labels=('endpoint',))
+REQUEST_QUERIES = Histogram('licksterr_request_sql_queries', "SQL queries issued while serving each endpoint.",
+                            labels=('endpoint',), buckets=QUERY_BUCKETS)
+SQL_QUERIES = Counter('licksterr_sql_queries_total', "SQL queries issued by the application.")
+CACHE_LOOKUPS = Counter('licksterr_cache_lookups_total',
+                        "Lookups of existing rows in get_or_create. A hit means no new row had to be created.",
+                        labels=('entity', 'result'))
+ANALYSIS_QUEUE = Gauge('licksterr_analysis_queue_depth', "Uploads currently undergoing analysis.")
+UPLOADS_REJECTED = Counter('licksterr_uploads_rejected_total',
+                           "Uploads turned away before analysis, by reason (invalid tab, too many tracks, busy).",
+                           labels=('reason',))
+
+
+def cache_lookup(entity, hit):
+    CACHE_LOOKUPS.labels(entity, 'hit' if hit else 'miss').inc()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    SQL_QUERIES.inc()
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+
+
+def before_request():
+    g.sql_queries = 0
+    g.request_start = perf_counter()
+
+
+def teardown_request(exception=None):
+    if 'request_start' not in g:
+        return
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_SECONDS.labels(endpoint).observe(perf_counter() - g.request_start)
+    REQUEST_QUERIES.labels(endpoint).observe(g.sql_queries)
+
+
+def init_metrics(app):
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+
+
+@metrics.route('/metrics', methods=['GET'])
+def expose():
+    return Response(REGISTRY.expose(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,132 @@
+import argparse
+import logging
+from collections import defaultdict
+
+from sqlalchemy import inspect, String
+from sqlalchemy.schema import CreateIndex
+
+from licksterr import setup_logging, create_app
+from licksterr.models import db, Note, Measure, FormMeasure, Track, QUARTER_TICKS
+from licksterr.queries import init_db
+from licksterr.similarity import backfill_form_vectors
+
+logger = logging.getLogger(__name__)
+
+# Fill the columns added to existing tables, run after every upgrade
+BACKFILLS = (
+    f"UPDATE beat SET ticks = {QUARTER_TICKS * 4} / duration WHERE ticks IS NULL",
+)
+
+
+def upgrade(engine=None):
+    """
+    Brings the schema up to date with the models: missing tables are created with all their indexes, and columns and
+    indexes added to existing tables are created afterwards. An empty database is then filled with notes and forms.
+    """
+    engine = engine if engine else db.engine
+    db.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name']: column for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                add_column(engine, column)
+            elif is_wider(column.type, existing[column.name]['type']) and engine.dialect.name != 'sqlite':
+                # SQLite doesn't enforce the length of strings
+                widen_column(engine, column)
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                create_index(engine, index)
+    for statement in BACKFILLS:
+        engine.execute(statement)
+    logger.info("Database schema is up to date.")
+    if not db.session.query(Note.query.exists()).scalar():
+        logger.info("Adding notes and forms to database")
+        init_db()
+    build_timelines()
+    backfill_form_vectors()
+
+
+def add_column(engine, column):
+    logger.info(f"Adding column {column.name} to {column.table.name}")
+    quote = engine.dialect.identifier_preparer.quote
+    column_type = column.type.compile(dialect=engine.dialect)
+    engine.execute(f"ALTER TABLE {quote(column.table.name)} ADD COLUMN {quote(column.name)} {column_type}")
+
+
+def is_wider(model_type, database_type):
+    return isinstance(model_type, String) and isinstance(database_type, String) and \
+           model_type.length and database_type.length and model_type.length > database_type.length
+
+
+def widen_column(engine, column):
+    logger.info(f"Widening column {column.name} of {column.table.name} to {column.type}")
+    quote = engine.dialect.identifier_preparer.quote
+    column_type = column.type.compile(dialect=engine.dialect)
+    engine.execute(f"ALTER TABLE {quote(column.table.name)} ALTER COLUMN {quote(column.name)} TYPE {column_type}")
+
+
+def create_index(engine, index):
+    logger.info(f"Creating index {index.name} on {index.table.name}")
+    if engine.dialect.name == 'postgresql':
+        # Builds the index without blocking writes on the table. This can't be done inside a transaction block.
+        statement = str(CreateIndex(index).compile(dialect=engine.dialect))
+        statement = statement.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(statement)
+    else:
+        index.create(engine)
+
+
+def build_timelines(batch_size=500):
+    """Builds the timelines of the tracks analyzed before they were introduced, one batch per transaction."""
+    built = 0
+    while True:
+        tracks = Track.query.filter(Track.timeline.is_(None)).order_by(Track.id).limit(batch_size).all()
+        if not tracks:
+            break
+        for track in tracks:
+            track.build_timeline()
+        db.session.commit()
+        built += len(tracks)
+        logger.info(f"Built the timelines of {built} tracks.")
+
+
+def pack_form_matches(batch_size=1000):
+    """
+    Moves the form matches stored as form_measure rows into the packed columns of their measures (see
+    FORM_MATCH_STORAGE), one batch of measures per transaction.
+    """
+    packed = 0
+    while True:
+        ids = [row.id for row in db.session.query(Measure.id).filter(Measure.form_ids.is_(None)).limit(batch_size)]
+        if not ids:
+            break
+        matches = defaultdict(dict)
+        for row in db.session.query(FormMeasure).filter(FormMeasure.measure_id.in_(ids)):
+            matches[row.measure_id][row.form_id] = row.match
+        for id in ids:
+            form_ids, form_matches = Measure.pack_form_matches(matches[id])
+            db.session.query(Measure).filter_by(id=id) \
+                .update({'form_ids': form_ids, 'form_matches': form_matches}, synchronize_session=False)
+        db.session.query(FormMeasure).filter(FormMeasure.measure_id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        packed += len(ids)
+        logger.info(f"Packed the form matches of {packed} measures.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Brings the database up to date with the models.")
+    parser.add_argument('--pack-form-matches', action='store_true',
+                        help="also move the form matches of existing measures into their packed columns")
+    args = parser.parse_args()
+    setup_logging(to_file=False)
+    create_app()
+    upgrade()
+    if args.pack_form_matches:
+        pack_form_matches()
+
+
+if __name__ == '__main__':
+    main()
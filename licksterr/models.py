@@ -1,18 +1,25 @@
 import bisect
 import logging
-from collections import defaultdict
+import threading
+from collections import defaultdict, namedtuple, OrderedDict
 from enum import Enum
-from fractions import Fraction
+from itertools import groupby
 
-from flask_sqlalchemy import SQLAlchemy
+from flask import current_app
 from mingus.core import notes, scales
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy import event, func
 from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.ext.mutable import MutableList
+from sqlalchemy.orm import make_transient_to_detached
 
-from licksterr.util import row2dict
+from licksterr.metrics import STAGE_SECONDS, cache_lookup
+from licksterr.profiling import profiled
+from licksterr.storage import IntArray, RoutingSQLAlchemy, insert_ignore, lock_for_reuse, written_keys
+from licksterr.util import row2dict, lazy_import
 
+np = lazy_import('numpy')
 logger = logging.getLogger(__name__)
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class Scale(Enum):
@@ -53,7 +60,13 @@ SCALES_TYPE = {
     False: [Scale.MINORPENTATONIC, Scale.AEOLIAN, Scale.DORIAN, Scale.PHRYGIAN, Scale.LOCRIAN, Scale.MINORBLUES]
 }
 STANDARD_TUNING = [4, 11, 7, 2, 9, 4]
+# Values of the FORM_MATCH_STORAGE setting: form matches of new measures are stored as one form_measure row per form,
+# or packed in two columns of the measure, which is far smaller but can't be queried by form in SQL
+FORM_MATCH_ROWS = 'rows'
+FORM_MATCH_PACKED = 'packed'
 FLOAT_PRECISION = 5
+QUARTER_TICKS = 960  # Guitar Pro time unit: ticks in a quarter note
+MEASURE_BATCH_SIZE = 200  # positions of a track whose measures are fetched together by Track.iter_measures
 
 
 class String:
@@ -93,7 +106,8 @@ class Song(db.Model):
     year = db.Column(db.Integer)
     hash = db.Column(db.String(128), unique=True)
     extension = db.Column(db.String(3))
-    tracks = db.relationship('Track', backref=db.backref("song"), cascade='all,delete')
+    # rows depending on a song are removed by the cascading foreign keys, not loaded and deleted one by one
+    tracks = db.relationship('Track', backref=db.backref("song"), cascade='all,delete', passive_deletes=True)
 
     def __str__(self):
         return f"{self.artist} - {self.title}"
@@ -109,8 +123,15 @@ class Track(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     song_id = db.Column(db.Integer, db.ForeignKey('song.id', ondelete='CASCADE'))
-    tuning = db.Column(ARRAY(db.Integer), nullable=False, default=STANDARD_TUNING)
-    keys = db.Column(ARRAY(db.Integer))
+    tuning = db.Column(MutableList.as_mutable(IntArray), nullable=False, default=STANDARD_TUNING)
+    keys = db.Column(MutableList.as_mutable(IntArray))
+    # pitch-class durations of each key-finding segment, packed by KeyFinder.pack_histograms
+    histograms = db.Column(db.LargeBinary)
+    # ids of the forms found for the track keys, and the cumulative match of each of them measure by measure
+    timeline_forms = db.Column(IntArray)
+    timeline = db.Column(db.LargeBinary)
+    # average match of every form per measure, in order of form id (see build_form_vector)
+    form_vector = db.Column(db.LargeBinary)
 
     measures = association_proxy('track_to_measure', 'measure')
     forms = association_proxy('track_to_form', 'form')
@@ -119,42 +140,142 @@ class Track(db.Model):
         song = Song.query.get(self.song_id)
         return f"Track #{self.id} for song {song}"
 
-    def add_key(self, key):
+    @profiled
+    @STAGE_SECONDS.labels('add_key').time()
+    def add_key(self, key, timeline=True):
+        """Adds the key and the form matches of its top scale. The timeline is rebuilt too, unless timeline is False."""
         if key in self.keys:
             return
         self.keys.append(key)
-        form_matches = defaultdict(float)
-        scale_matches = defaultdict(float)
-        total_length = 0
         key, is_major = KEYS[key]
-        for tm in TrackMeasure.get_measures(self):
-            if any(beat.notes for beat in tm.measure.beats):
-                total_length += len(tm.indexes)
-            for fm in FormMeasure.get_forms(tm.measure):
-                form = fm.form
-                if form.tuning == self.tuning and form.key == key and form.scale in SCALES_TYPE[is_major]:
-                    score = fm.match * len(tm.indexes)
-                    form_matches[form] += score
-                    scale_matches[form.scale] += score
+        forms = [form for form in Form.query.filter(Form.key == key, Form.scale.in_(SCALES_TYPE[is_major]))
+                 .order_by(Form.id) if form.tuning == self.tuning]
+        form_ids = np.array([form.id for form in forms], dtype=np.int32)
+        form_matches = np.zeros(len(forms))
+        total_length = 0
+        for measure_id, indexes, measure_forms, matches in TrackMeasure.get_form_matches(self):
+            if Measure.has_notes(measure_id):
+                total_length += len(indexes)
+            found = np.isin(measure_forms, form_ids)
+            np.add.at(form_matches, np.searchsorted(form_ids, measure_forms[found]), matches[found] * len(indexes))
+        scale_matches = defaultdict(float)
+        for form, match in zip(forms, form_matches):
+            if match:
+                scale_matches[form.scale] += match
+        if not scale_matches:
+            return
         # In case of ties, the order specified in SCALES_TYPE is used as tiebraker (0.0001 should be small enough to not
         # alter significantly the results
         top_scale = max(scale_matches,
                         key=lambda scale: scale_matches[scale] - 10 ** (-3) * SCALES_TYPE[is_major].index(scale))
-        for form, match in form_matches.items():
-            if form.scale == top_scale:
-                tf = TrackForm(track=self, form=form, match=match / total_length)
+        for form, match in zip(forms, form_matches):
+            if match and form.scale == top_scale:
+                tf = TrackForm(track=self, form=form, match=float(match) / total_length)
                 db.session.add(tf)
+        if timeline:
+            self.build_timeline()
+
+    def set_keys(self, keys):
+        """Replaces the keys of this track and the form matches computed for them."""
+        TrackForm.query.filter_by(track_id=self.id).delete(synchronize_session=False)
+        db.session.expire(self, ['track_to_form'])
+        self.keys = []
+        for key in keys:
+            self.add_key(key, timeline=False)
+        self.build_timeline()
+
+    def build_timeline(self):
+        """
+        Stores the match of each form of this track measure by measure, as a (measures + 1) x (forms + 1) matrix of
+        cumulative sums: the match of a form over any range of measures is the difference between two rows. The first
+        column counts the measures, so that the matrix keeps its length when no form is found.
+        """
+        form_ids = np.array(sorted({tf.form.id for tf in self.track_to_form}), dtype=np.int32)
+        measures = list(TrackMeasure.get_form_matches(self))
+        length = max((max(indexes) + 1 for _, indexes, _, _ in measures), default=0)
+        timeline = np.zeros((length + 1, len(form_ids) + 1), dtype=np.float32)
+        timeline[1:, 0] = 1
+        for _, indexes, measure_forms, matches in measures:
+            found = np.isin(measure_forms, form_ids)
+            columns = np.searchsorted(form_ids, measure_forms[found]) + 1
+            timeline[np.ix_(np.array(indexes) + 1, columns)] = matches[found]
+        self.timeline_forms = form_ids.tolist()
+        self.timeline = np.cumsum(timeline, axis=0, dtype='<f4').tobytes()
+
+    def build_form_vector(self):
+        """
+        Stores how much the track uses each form of the form table, whatever its keys: the matches of every form in the
+        measures of the track, weighted by the times each measure is repeated and divided by the number of measures.
+        The vector has an entry for every form id in ascending order, so vectors stored before new forms were added are
+        only shorter.
+        """
+        form_ids = Form.get_ids()
+        vector = np.zeros(len(form_ids), dtype=np.float64)
+        length = 0
+        for _, indexes, measure_forms, matches in TrackMeasure.get_form_matches(self):
+            # packed matches can still refer to deleted forms
+            found = np.isin(measure_forms, form_ids)
+            np.add.at(vector, np.searchsorted(form_ids, measure_forms[found]), matches[found] * len(indexes))
+            length += len(indexes)
+        self.form_vector = (vector / max(length, 1)).astype('<f4').tobytes()
+
+    @staticmethod
+    def unpack_form_vector(blob, size):
+        """Unpacks a form vector, padded with zeros up to the given number of forms."""
+        vector = np.zeros(size, dtype=np.float32)
+        values = np.frombuffer(blob, dtype='<f4')[:size]
+        vector[:len(values)] = values
+        return vector
+
+    def get_timeline(self, start=0, end=None, window=1):
+        """Splits the measures in [start, end) in windows of the given size and scores the forms in each of them."""
+        timeline = np.frombuffer(self.timeline, dtype='<f4').reshape(-1, len(self.timeline_forms) + 1)
+        measures = len(timeline) - 1
+        end = measures if end is None else min(end, measures)
+        window = max(window, 1)
+        starts = np.arange(max(start, 0), end, window)
+        ends = np.minimum(starts + window, end)
+        scores = (timeline[ends, 1:] - timeline[starts, 1:]) / (ends - starts)[:, None]
+        forms = {form.id: form for form in Form.query.filter(Form.id.in_(self.timeline_forms))}
+        windows = []
+        for window_start, window_end, window_scores in zip(starts, ends, scores):
+            windows.append({
+                'start': int(window_start),
+                'end': int(window_end),
+                'forms': [{**forms[self.timeline_forms[i]].to_dict(), 'match': float(window_scores[i])}
+                          for i in np.argsort(-window_scores, kind='stable') if window_scores[i] > 0]
+            })
+        return {'measures': measures, 'windows': windows}
+
+    def iter_measures(self, batch_size=MEASURE_BATCH_SIZE):
+        """
+        Yields the measures of the track in playback order, each with its beats in order. Only the ids of the measures
+        are read upfront: their beats and notes are fetched with two queries per batch_size positions of the track, so
+        memory doesn't grow with its length. A measure repeated in a batch is the same dict.
+        """
+        playback = []
+        query = db.session.query(TrackMeasure.measure_id, TrackMeasure.indexes).filter(TrackMeasure.track_id == self.id)
+        for measure_id, indexes in query:
+            playback.extend((i, measure_id) for i in indexes)
+        playback = [measure_id for _, measure_id in sorted(playback)]
+        for start in range(0, len(playback), batch_size):
+            batch = playback[start:start + batch_size]
+            measures = Measure.get_beats(set(batch))
+            for measure_id in batch:
+                yield measures.get(measure_id, {'id': measure_id, 'beats': []})
 
     def remove_key(self, key):
-        try:
-            self.keys.remove(key)
-            key, is_major = key
-            for tm in TrackForm.get_forms(self):
-                if tm.form.scale in SCALES_TYPE[is_major] and tm.form.key == key:
-                    db.session.delete(tm)
-            db.session.commit()
-        except ValueError:
-            pass
+        """Removes the key and the form matches found for it, and rebuilds the timeline."""
+        if key not in self.keys:
+            return
+        self.keys.remove(key)
+        key, is_major = KEYS[key]
+        for tm in TrackForm.get_forms(self):
+            if tm.form.scale in SCALES_TYPE[is_major] and tm.form.key == key:
+                db.session.delete(tm)
+        db.session.flush()
+        db.session.expire(self, ['track_to_form'])
+        self.build_timeline()
 
     def to_dict(self):
         info = row2dict(self)
@@ -174,12 +295,13 @@ class Form(db.Model):
     __tablename__ = 'form'
     __table_args__ = (
         db.UniqueConstraint('key', 'scale', 'name', 'tuning'),
+        db.Index('ix_form_lookup', 'key', 'scale', 'name', 'id'),
     )
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.Integer, nullable=False)
     scale = db.Column(db.Enum(Scale), nullable=False)
     name = db.Column(db.String(), nullable=False)
-    tuning = db.Column(ARRAY(db.Integer), nullable=False, default=STANDARD_TUNING)
+    tuning = db.Column(MutableList.as_mutable(IntArray), nullable=False, default=STANDARD_TUNING)
     measures = association_proxy('form_to_measure', 'measure')
     notes = association_proxy('form_to_note', 'note')
 
@@ -212,6 +334,10 @@ class Form(db.Model):
     def get(cls, key, scale, name):
         return cls.query.filter_by(key=key, scale=scale, name=name).first()
 
+    @classmethod
+    def get_ids(cls):
+        return np.array([row.id for row in db.session.query(cls.id).order_by(cls.id)], dtype=np.int32)
+
     @classmethod
     def calculate_caged_form(cls, key, scale, form, form_start=0, transpose=False):
         """
@@ -277,6 +403,11 @@ class Measure(db.Model):
     __tablename__ = 'measure'
 
     id = db.Column(db.String(), primary_key=True)
+    # form matches of measures stored in packed mode (see FORM_MATCH_STORAGE): sorted form ids and float16 matches
+    form_ids = db.Column(IntArray)
+    form_matches = db.Column(db.LargeBinary)
+    # highest form id when the forms were matched (see NoteSet.get_generation), older measures miss the newer forms
+    form_generation = db.Column(db.Integer)
     forms = association_proxy('measure_to_form', 'form')
     beats = association_proxy('measure_to_beat', 'beat')
 
@@ -288,68 +419,143 @@ class Measure(db.Model):
         return info
 
     @classmethod
+    @profiled
+    @STAGE_SECONDS.labels('measure_persistence').time()
     def get_or_create(cls, beats):
         """
-        Retrieves the measure with the given beats or creates a new one from them. Upon creation, known forms in the
-        database are matched against the notes found in each beat and % of matching is calculated.
+        Stores the measure made of the given beats (see Beat.get_or_create) if it doesn't exist yet, and returns its id.
+        The measure is inserted ignoring conflicts, so concurrent uploads sharing it don't fail: only the transaction
+        that actually inserts it stores its beats and matches the known forms against the notes of each beat.
+        The form matches are stored as form_measure rows or in the packed columns of the measure, depending on the
+        FORM_MATCH_STORAGE setting.
         """
         id = ''.join(beat.id for beat in beats)
-        measure = Measure.query.get(id)
-        if not measure:
-            measure = Measure(id=id)
-            form_match = defaultdict(float)  # % of duration a form occupies in this measure
+        written = written_keys(db.session, cls.__table__)
+        row = {'id': id, 'form_generation': NoteSet.get_generation()}
+        inserted = id not in written and bool(insert_ignore(db.session, cls.__table__, row))
+        if id not in written and not inserted and not lock_for_reuse(db.session, cls.__table__, id):
+            # deleted as an orphan since the insert
+            inserted = bool(insert_ignore(db.session, cls.__table__, row))
+        written.add(id)
+        cache_lookup('measure', not inserted)
+        if inserted:
+            indexes = defaultdict(list)  # positions of each beat in the measure
+            form_match = defaultdict(int)  # ticks of this measure covered by each form, then % of its duration
             total_duration = 0
             for i, beat in enumerate(beats):
-                mb = MeasureBeat.get(measure, beat)
-                if not mb:
-                    db.session.add(MeasureBeat(measure=measure, beat=beat, indexes=[i]))
-                else:
-                    mb.indexes.append(i)
-                beat_duration = Fraction(1 / beat.duration)
+                indexes[beat.id].append(i)
+                beat_duration = beat.ticks
                 if beat.notes:
                     total_duration += beat_duration
-                    containing_forms = set(beat.notes[0].forms)
-                    for note in beat.notes[1:]:
-                        containing_forms.intersection_update(note.forms)
-                    for form in containing_forms:
-                        form_match[form] += beat_duration
-            for form in form_match:
-                form_match[form] /= total_duration
-            for form, match in form_match.items():
-                db.session.add(FormMeasure(form=form, measure=measure, match=match))
-        return measure
+                    with STAGE_SECONDS.labels('form_matching').time():
+                        containing_forms = NoteSet.get_forms(beat.notes)
+                    for form_id in containing_forms:
+                        form_match[form_id] += beat_duration
+            insert_ignore(db.session, MeasureBeat.__table__,
+                          [{'measure_id': id, 'beat_id': beat_id, 'indexes': i} for beat_id, i in indexes.items()])
+            for form_id in form_match:
+                form_match[form_id] /= total_duration
+            if current_app.config.get('FORM_MATCH_STORAGE', FORM_MATCH_ROWS) == FORM_MATCH_PACKED:
+                form_ids, form_matches = cls.pack_form_matches(form_match)
+                db.session.execute(cls.__table__.update().where(cls.__table__.c.id == id)
+                                   .values(form_ids=form_ids, form_matches=form_matches))
+            elif form_match:
+                insert_ignore(db.session, FormMeasure.__table__,
+                              [{'form_id': form_id, 'measure_id': id, 'match': match}
+                               for form_id, match in form_match.items()])
+        return id
+
+    @staticmethod
+    def pack_form_matches(form_match):
+        """Packs a dict of form id: match in the sorted list of form ids and the blob of their float16 matches."""
+        form_ids = sorted(form_match)
+        return form_ids, np.array([form_match[form_id] for form_id in form_ids], dtype='<f2').tobytes()
+
+    @staticmethod
+    def unpack_form_matches(form_ids, form_matches):
+        return np.array(form_ids, dtype=np.int32), np.frombuffer(form_matches, dtype='<f2').astype(np.float32)
+
+    @staticmethod
+    def get_beats(ids):
+        """Returns the measures with the given ids as dicts with their beats in order, fetched with two queries."""
+        ids = list(ids)
+        notes = defaultdict(list)
+        query = db.session.query(BeatNote.beat_id, Note.id, Note.string, Note.fret, Note.muted) \
+            .join(Note, Note.id == BeatNote.note_id).join(MeasureBeat, MeasureBeat.beat_id == BeatNote.beat_id) \
+            .filter(MeasureBeat.measure_id.in_(ids)).distinct().order_by(BeatNote.beat_id, Note.string, Note.fret)
+        for beat_id, *note in query:
+            notes[beat_id].append(dict(zip(('id', 'string', 'fret', 'muted'), note)))
+        measures = {}
+        query = db.session.query(MeasureBeat.measure_id, MeasureBeat.indexes, Beat.duration, Beat.ticks, Beat.id) \
+            .join(Beat, Beat.id == MeasureBeat.beat_id).filter(MeasureBeat.measure_id.in_(ids))
+        for measure_id, indexes, duration, ticks, beat_id in query:
+            beats = measures.setdefault(measure_id, {'id': measure_id, 'beats': {}})['beats']
+            for i in indexes:
+                beats[i] = {'duration': duration, 'ticks': ticks, 'notes': notes[beat_id]}
+        for measure in measures.values():
+            measure['beats'] = [measure['beats'][i] for i in sorted(measure['beats'])]
+        return measures
+
+    @staticmethod
+    def has_notes(id):
+        """Whether the measure with the given id has any note: every note in a beat id starts with S (see Note)."""
+        return 'S' in id
+
+
+# Beat stored by Beat.get_or_create, with the Note objects it's made of
+BeatInfo = namedtuple('BeatInfo', ('id', 'duration', 'ticks', 'notes'))
 
 
 class Beat(db.Model):
     __tablename__ = 'beat'
 
-    id = db.Column(db.String(39), primary_key=True)  # 39 max length (6 notes * 6 ('SxFyyP') + 3 ('Dzz')
+    # 44 max length (6 notes * 6 ('SxFyyP') + 3 ('Dzz') + 5 ('Tdddd', only for dotted notes and tuplets)
+    id = db.Column(db.String(44), primary_key=True)
     duration = db.Column(db.Integer, nullable=False)  # duration of the note(s) (1 - whole, 2 - half, ...)
+    ticks = db.Column(db.Integer)  # exact duration in QUARTER_TICKS per quarter note, dots and tuplets included
     notes = association_proxy('beat_to_note', 'note')
 
     def to_dict(self):
-        return {'duration': self.duration, 'notes': [note.to_dict() for note in self.notes]}
+        return {'duration': self.duration, 'ticks': self.ticks, 'notes': [note.to_dict() for note in self.notes]}
 
     @classmethod
+    @STAGE_SECONDS.labels('beat_persistence').time()
     def get_or_create(cls, beat):
+        """
+        Stores the given Guitar Pro beat if it doesn't exist yet, inserting it ignoring conflicts with concurrent
+        uploads. Returns a BeatInfo rather than the ORM object, which would have to be loaded.
+        """
         if len(beat.notes) > 6:
             raise ValueError("Can't have more than two notes per string!")
         notes = tuple(Note.get(note.string, note.value)
                       for note in sorted(beat.notes, key=lambda note: (note.string, note.value)))
+        ticks = beat.duration.time
         id = ''.join(repr(note) for note in notes) + f'D{beat.duration.value:02}'
-        b = Beat.query.get(id)
-        if not b:
-            b = Beat(id=id, duration=beat.duration.value)
-            db.session.add(b)
-            for note in notes:
-                db.session.add(BeatNote(beat=b, note=note))
-        return b
+        if ticks != cls.get_ticks(beat.duration.value):
+            id += f'T{ticks:04}'
+        written = written_keys(db.session, cls.__table__)
+        row = {'id': id, 'duration': beat.duration.value, 'ticks': ticks}
+        inserted = id not in written and bool(insert_ignore(db.session, cls.__table__, row))
+        if id not in written and not inserted and not lock_for_reuse(db.session, cls.__table__, id):
+            # deleted as an orphan since the insert
+            inserted = bool(insert_ignore(db.session, cls.__table__, row))
+        written.add(id)
+        cache_lookup('beat', not inserted)
+        if inserted and notes:
+            insert_ignore(db.session, BeatNote.__table__, [{'beat_id': id, 'note_id': note.id} for note in notes])
+        return BeatInfo(id, beat.duration.value, ticks, notes)
+
+    @staticmethod
+    def get_ticks(duration):
+        """Ticks of a plain (not dotted, not tuplet) note of the given duration"""
+        return QUARTER_TICKS * 4 // duration
 
 
 class Note(db.Model):
     __tablename__ = 'note'
     __table_args__ = (
         db.UniqueConstraint('string', 'fret', 'muted'),
+        db.Index('ix_note_lookup', 'string', 'fret', 'muted', 'id'),
     )
 
     id = db.Column(db.Integer, primary_key=True)
@@ -366,7 +572,126 @@ class Note(db.Model):
 
     @classmethod
     def get(cls, string, fret, muted=False):
-        return cls.query.filter_by(string=string, fret=fret, muted=muted).first()
+        note = NOTE_TABLE.get(string, fret, muted)
+        # merging without loading attaches the cached note to the current session without querying the database
+        return db.session.merge(note, load=False) if note else None
+
+
+class NoteTable:
+    """
+    Read-only copy of the note table held by each process. The table is tiny and never changes after init_db, so the
+    notes are loaded once into a dense list indexed by (string, fret, muted) and handed out detached from any session.
+    The copy is dropped whenever this process inserts or deletes notes and reloaded on the next lookup.
+    """
+    STRINGS = 6
+
+    def __init__(self):
+        self.notes = None
+        self.frets = 0
+
+    def load(self):
+        rows = db.session.query(Note.id, Note.string, Note.fret, Note.muted).all()
+        frets = max((row.fret for row in rows), default=-1) + 1
+        notes = [None] * (2 * (self.STRINGS + 1) * frets)
+        for id, string, fret, muted in rows:
+            note = Note(id=id, string=string, fret=fret, muted=muted)
+            make_transient_to_detached(note)
+            notes[self.index(string, fret, muted, frets)] = note
+        self.frets = frets
+        self.notes = notes
+        logger.debug(f"Loaded {len(rows)} notes in the lookup table.")
+
+    def clear(self):
+        self.notes = None
+
+    @classmethod
+    def index(cls, string, fret, muted, frets):
+        return ((cls.STRINGS + 1) * int(muted) + string) * frets + fret
+
+    def get(self, string, fret, muted=False):
+        """Returns the detached note, or None if it is not in the table."""
+        # an empty table is loaded once too
+        if self.notes is None:
+            self.load()
+        if not (0 < string <= self.STRINGS and 0 <= fret < self.frets):
+            return None
+        return self.notes[self.index(string, fret, muted, self.frets)]
+
+
+NOTE_TABLE = NoteTable()
+
+
+@event.listens_for(Note, 'after_insert')
+@event.listens_for(Note, 'after_delete')
+def clear_note_table(mapper, connection, target):
+    NOTE_TABLE.clear()
+
+
+class NoteSet(db.Model):
+    """
+    Ids of the forms that contain every note of a set of notes. Many beats share the same notes with a different
+    duration, so the forms are computed once per set and the result is shared through the database by every process.
+    Recently used sets are also kept in memory.
+    Forms are only ever added, so the highest form id is the generation of the form table. Every set records the
+    generation it was matched at, and a set older than the generation seen by this process is matched again. Each
+    process reads the generation again at every upload (see sync_generation).
+    """
+    __tablename__ = 'note_set'
+    CACHE_SIZE = 2 ** 16
+    cache = OrderedDict()  # id: (generation, forms)
+    # request handlers run in threads
+    cache_lock = threading.Lock()
+    generation = None
+
+    id = db.Column(db.String(36), primary_key=True)  # 36 max length (6 notes * 6 ('SxFyyP'))
+    form_ids = db.Column(IntArray, nullable=False)
+    form_generation = db.Column(db.Integer)
+
+    @classmethod
+    def sync_generation(cls):
+        cls.generation = db.session.query(func.coalesce(func.max(Form.id), 0)).scalar()
+        return cls.generation
+
+    @classmethod
+    def get_generation(cls):
+        return cls.sync_generation() if cls.generation is None else cls.generation
+
+    @classmethod
+    def get_forms(cls, notes):
+        notes = sorted(notes, key=lambda note: (note.string, note.fret, note.muted))
+        id = ''.join(repr(note) for note in notes)
+        generation = cls.get_generation()
+        with cls.cache_lock:
+            cached = cls.cache.get(id)
+            if cached is not None and cached[0] >= generation:
+                cls.cache.move_to_end(id)
+                return cached[1]
+        note_set = cls.query.get(id)
+        cache_lookup('note_set', note_set is not None)
+        if note_set and (note_set.form_generation or 0) >= generation:
+            generation, forms = note_set.form_generation, frozenset(note_set.form_ids)
+        else:
+            forms = frozenset(cls.match_forms(note.id for note in notes))
+            row = {'id': id, 'form_ids': sorted(forms), 'form_generation': generation}
+            if note_set:
+                # never overwrites a set matched at a later generation by another process
+                db.session.execute(cls.__table__.update().values(row).where(db.and_(
+                    cls.__table__.c.id == id, db.or_(cls.__table__.c.form_generation.is_(None),
+                                                     cls.__table__.c.form_generation < generation))))
+            else:
+                insert_ignore(db.session, cls.__table__, row)
+        with cls.cache_lock:
+            cls.cache[id] = (generation, forms)
+            if len(cls.cache) > cls.CACHE_SIZE:
+                cls.cache.popitem(last=False)
+        return forms
+
+    @staticmethod
+    def match_forms(note_ids):
+        note_ids = set(note_ids)
+        query = db.session.query(FormNote.form_id).filter(FormNote.note_id.in_(note_ids)) \
+            .group_by(FormNote.form_id).having(func.count(FormNote.note_id) == len(note_ids))
+        return (form_id for form_id, in query)
 
 
 # Associations
@@ -377,7 +702,8 @@ class TrackForm(db.Model):
     # % of this form in the track
     match = db.Column(db.Float(precision=FLOAT_PRECISION))
     # relationships
-    track = db.relationship('Track', backref=db.backref('track_to_form', cascade='all, delete-orphan'))
+    track = db.relationship('Track', backref=db.backref('track_to_form', cascade='all, delete-orphan',
+                                                         passive_deletes=True))
     form = db.relationship('Form', backref=db.backref('form_to_track', cascade='all, delete-orphan'))
 
     @classmethod
@@ -396,15 +722,19 @@ class TrackForm(db.Model):
 
 class TrackMeasure(db.Model):
     __tablename__ = 'track_measure'
+    __table_args__ = (
+        db.Index('ix_track_measure_measure_id', 'measure_id'),
+    )
 
     track_id = db.Column(db.Integer, db.ForeignKey('track.id', ondelete='cascade'), primary_key=True)
     measure_id = db.Column(db.String(), db.ForeignKey('measure.id', ondelete='cascade'), primary_key=True)
     # % that this measure occupies in the track
     match = db.Column(db.Float(precision=FLOAT_PRECISION))
-    indexes = db.Column(db.ARRAY(db.Integer))
+    indexes = db.Column(MutableList.as_mutable(IntArray))
     key = db.Column(db.Integer)
 
-    track = db.relationship('Track', backref=db.backref("track_to_measure", cascade='all, delete-orphan'))
+    track = db.relationship('Track', backref=db.backref("track_to_measure", cascade='all, delete-orphan',
+                                                         passive_deletes=True))
     measure = db.relationship('Measure', backref=db.backref("measure_to_track", cascade='all, delete-orphan'))
 
     def __str__(self):
@@ -414,9 +744,35 @@ class TrackMeasure(db.Model):
     def get_measures(cls, track):
         return cls.query.filter_by(track=track).all()
 
+    @classmethod
+    def get_form_matches(cls, track):
+        """
+        Yields the id and the indexes of every measure of the track with the ids of its forms and their match, in one
+        query. The matches are read from the packed columns of the measure or from form_measure, depending on how the
+        measure was stored (see FORM_MATCH_STORAGE).
+        """
+        query = db.session.query(cls.measure_id, cls.indexes, Measure.form_ids, Measure.form_matches,
+                                 FormMeasure.form_id, FormMeasure.match) \
+            .join(Measure, Measure.id == cls.measure_id) \
+            .outerjoin(FormMeasure, FormMeasure.measure_id == cls.measure_id) \
+            .filter(cls.track == track).order_by(cls.measure_id)
+        for measure_id, rows in groupby(query, key=lambda row: row.measure_id):
+            rows = list(rows)
+            if rows[0].form_ids is not None:
+                form_ids, matches = Measure.unpack_form_matches(rows[0].form_ids, rows[0].form_matches)
+            else:
+                matches = [(row.form_id, row.match) for row in rows if row.form_id is not None]
+                form_ids = np.array([form_id for form_id, _ in matches], dtype=np.int32)
+                matches = np.array([match for _, match in matches], dtype=np.float32)
+            yield measure_id, rows[0].indexes, form_ids, matches
+
 
 class FormMeasure(db.Model):
     __tablename__ = 'form_measure'
+    __table_args__ = (
+        # covers get_forms, which filters on the second column of the primary key
+        db.Index('ix_form_measure_measure_id', 'measure_id', 'form_id', 'match'),
+    )
 
     form_id = db.Column(db.Integer, db.ForeignKey('form.id'), primary_key=True)
     measure_id = db.Column(db.String(), db.ForeignKey('measure.id'), primary_key=True)
@@ -440,10 +796,14 @@ class FormMeasure(db.Model):
 
 class MeasureBeat(db.Model):
     __tablename__ = 'measure_beat'
+    __table_args__ = (
+        # lets the orphan collector find the beats no measure uses anymore
+        db.Index('ix_measure_beat_beat_id', 'beat_id'),
+    )
 
     measure_id = db.Column(db.String(), db.ForeignKey('measure.id'), primary_key=True)
-    beat_id = db.Column(db.String(39), db.ForeignKey('beat.id'), primary_key=True)
-    indexes = db.Column(ARRAY(db.Integer))
+    beat_id = db.Column(db.String(44), db.ForeignKey('beat.id'), primary_key=True)
+    indexes = db.Column(MutableList.as_mutable(IntArray))
 
     measure = db.relationship('Measure', backref=db.backref('measure_to_beat', cascade='all, delete-orphan'))
     beat = db.relationship('Beat', backref=db.backref('beat_to_measure', cascade='all, delete-orphan'))
@@ -455,6 +815,10 @@ class MeasureBeat(db.Model):
 
 class FormNote(db.Model):
     __tablename__ = 'form_note'
+    __table_args__ = (
+        # Note.forms is looked up by note
+        db.Index('ix_form_note_note_id', 'note_id', 'form_id'),
+    )
 
     form_id = db.Column(db.Integer, db.ForeignKey('form.id'), primary_key=True)
     note_id = db.Column(db.Integer, db.ForeignKey('note.id'), primary_key=True)
@@ -467,7 +831,7 @@ class FormNote(db.Model):
 class BeatNote(db.Model):
     __tablename__ = 'beat_note'
 
-    beat_id = db.Column(db.String(39), db.ForeignKey('beat.id'), primary_key=True)
+    beat_id = db.Column(db.String(44), db.ForeignKey('beat.id'), primary_key=True)
     note_id = db.Column(db.Integer, db.ForeignKey('note.id'), primary_key=True)
     # todo store not effect here
     # relationships
@@ -0,0 +1,222 @@
+"""
+Opt-in profiling of live requests, enabled by PROFILING_ENABLED. A request is profiled when it carries the X-Profile
+header ('cprofile' for the deterministic profiler, 'sample' for the sampling one) or when its endpoint is listed in
+PROFILING_ENDPOINTS. Functions decorated with profiled are profiled on every call when listed in PROFILING_FUNCTIONS,
+which covers the CLI jobs too. Profiles are saved in PROFILING_DIR, as pstats dumps or collapsed stacks, and downloaded
+from /admin/profiles. The X-Profile header and /admin/profiles require the value of PROFILING_TOKEN in the
+X-Profile-Token header, and are disabled when no token is set.
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import wraps
+from pathlib import Path
+
+from flask import Blueprint, Response, abort, current_app, g, has_app_context, jsonify, request, send_file
+
+logger = logging.getLogger(__name__)
+profiling = Blueprint('profiling', __name__)
+
+PROFILE_HEADER = 'X-Profile'
+TOKEN_HEADER = 'X-Profile-Token'
+CPROFILE = 'cprofile'
+SAMPLE = 'sample'
+EXTENSIONS = {CPROFILE: 'prof', SAMPLE: 'folded'}
+DEFAULT_INTERVAL = 0.005  # seconds between two samples
+DEFAULT_KEEP = 100  # profiles kept in PROFILING_DIR, the oldest are deleted
+
+# Only one deterministic profiler can run at a time in a process
+_cprofile_lock = threading.Lock()
+
+
+class DeterministicProfiler:
+    kind = CPROFILE
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        if not _cprofile_lock.acquire(blocking=False):
+            return False
+        self.profile.enable()
+        return True
+
+    def stop(self):
+        self.profile.disable()
+        _cprofile_lock.release()
+
+    def dump(self, path):
+        self.profile.dump_stats(str(path))
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the profiled thread from a background thread at a fixed interval. The overhead doesn't depend
+    on the number of calls, and the stacks are saved in the collapsed format read by flame graph tools.
+    """
+    kind = SAMPLE
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._sampler.start()
+        return True
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def get_dir():
+    path = Path(current_app.config.get('PROFILING_DIR', Path(tempfile.gettempdir()) / 'licksterr-profiles'))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def new_profiler(kind):
+    if kind == SAMPLE:
+        return SamplingProfiler(current_app.config.get('PROFILING_INTERVAL', DEFAULT_INTERVAL))
+    return DeterministicProfiler()
+
+
+def save(profiler, target, seconds):
+    """Saves the profile with its description in PROFILING_DIR and returns its id."""
+    path = get_dir()
+    id = uuid.uuid4().hex
+    profiler.dump(path / f"{id}.{EXTENSIONS[profiler.kind]}")
+    info = {'id': id, 'kind': profiler.kind, 'target': target, 'seconds': round(seconds, 6), 'created': time.time()}
+    (path / f"{id}.json").write_text(json.dumps(info))
+    profiles = sorted(path.glob('*.json'), key=os.path.getmtime)
+    for old in profiles[:max(len(profiles) - current_app.config.get('PROFILING_KEEP', DEFAULT_KEEP), 0)]:
+        for file in path.glob(f"{old.stem}.*"):
+            file.unlink()
+    logger.info(f"Saved {profiler.kind} profile {id} of {target} ({seconds:.3f}s)")
+    return id
+
+
+def profiled(f):
+    """Profiles every call of the function when its qualified name is in PROFILING_FUNCTIONS."""
+    name = f.__qualname__
+
+    @wraps(f)
+    def wrap(*args, **kw):
+        if not (has_app_context() and current_app.config.get('PROFILING_ENABLED') and
+                name in current_app.config.get('PROFILING_FUNCTIONS', ())):
+            return f(*args, **kw)
+        profiler = DeterministicProfiler()
+        if not profiler.start():
+            # already inside a profiled request or function
+            return f(*args, **kw)
+        start = time.perf_counter()
+        try:
+            return f(*args, **kw)
+        finally:
+            profiler.stop()
+            save(profiler, name, time.perf_counter() - start)
+
+    return wrap
+
+
+def authorized():
+    token = current_app.config.get('PROFILING_TOKEN')
+    return bool(token) and request.headers.get(TOKEN_HEADER) == token
+
+
+def before_request():
+    if not current_app.config.get('PROFILING_ENABLED'):
+        return
+    kind = request.headers.get(PROFILE_HEADER)
+    if kind is None and request.endpoint in current_app.config.get('PROFILING_ENDPOINTS', ()):
+        kind = CPROFILE
+    if kind is None:
+        return
+    if request.headers.get(PROFILE_HEADER) and not authorized():
+        logger.info(f"Not profiling {request.path}: missing or wrong {TOKEN_HEADER}.")
+        return
+    profiler = new_profiler(kind)
+    if profiler.start():
+        g.profiler = profiler
+        g.profile_start = time.perf_counter()
+    else:
+        logger.info(f"Not profiling {request.path}: another profile is running.")
+
+
+def after_request(response):
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.stop()
+        id = save(profiler, f"{request.method} {request.path}", time.perf_counter() - g.profile_start)
+        response.headers['X-Profile-Id'] = id
+    return response
+
+
+def teardown_request(exception=None):
+    # the request failed before after_request
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.stop()
+        save(profiler, f"{request.method} {request.path}", time.perf_counter() - g.profile_start)
+
+
+def init_profiling(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+
+
+@profiling.before_request
+def check_access():
+    if not (current_app.config.get('PROFILING_ENABLED') and current_app.config.get('PROFILING_TOKEN')):
+        abort(404)
+    if not authorized():
+        abort(403)
+
+
+@profiling.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    profiles = [json.loads(path.read_text()) for path in get_dir().glob('*.json')]
+    return jsonify(sorted(profiles, key=lambda profile: profile['created'], reverse=True))
+
+
+@profiling.route('/admin/profiles/<id>', methods=['GET'])
+def get_profile(id):
+    """Downloads the profile. With ?format=text, pstats profiles are rendered as the 50 most expensive functions."""
+    try:
+        info = json.loads((get_dir() / f"{uuid.UUID(hex=id).hex}.json").read_text())
+    except (ValueError, FileNotFoundError):
+        abort(404)
+    path = get_dir() / f"{info['id']}.{EXTENSIONS[info['kind']]}"
+    if info['kind'] == CPROFILE and request.args.get('format') == 'text':
+        stream = io.StringIO()
+        pstats.Stats(str(path), stream=stream).sort_stats('cumulative').print_stats(50)
+        return Response(stream.getvalue(), mimetype='text/plain')
+    return send_file(str(path), as_attachment=True, attachment_filename=path.name)
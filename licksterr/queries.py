@@ -1,8 +1,8 @@
 import logging
 
-from mingus.core import keys
+from mingus.core import keys, notes
 
-from licksterr.models import SCALES_DICT, Form, db, Note
+from licksterr.models import SCALES_DICT, Form, db, Note, Scale
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +23,20 @@ def init_db():
     logger.info("Database initialization completed.")
 
 
+def sync_forms():
+    """Adds the forms of the scales in SCALES_DICT that aren't in the database yet. Returns the ids of the new forms."""
+    new_forms = []
+    for key, scale in yield_scales():
+        for form_name in 'CAGED':
+            if not Form.get(notes.note_to_int(key), getattr(Scale, scale.__name__.upper()), form_name):
+                logger.debug(f"Generating {key} {scale} {form_name}")
+                new_forms.append(Form.calculate_caged_form(key, scale, form_name, transpose=True))
+    db.session.add_all(new_forms)
+    db.session.commit()
+    logger.info(f"Added {len(new_forms)} new forms.")
+    return [form.id for form in new_forms]
+
+
 def yield_scales(scales_list=SCALES_DICT.keys(), keys_list=None):
     for scale in scales_list:
         current_keys = keys_list
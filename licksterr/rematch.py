@@ -0,0 +1,156 @@
+"""
+Matches the measures already in the database against forms added after they were analyzed, without parsing any tab
+again. By default the forms of the scales in SCALES_DICT that are missing from the database are created first.
+Usage: python -m licksterr.rematch [--forms ID,...] [--batch-size N]
+Running workers pick up the new forms at their next upload (see NoteSet). Measures record the generation of the forms
+they were matched against, so measures ingested with older forms while the job runs are matched by a further pass, and
+running the job again matches the ones committed after it ended.
+"""
+import argparse
+import logging
+
+from sqlalchemy import func
+
+from licksterr import setup_logging, create_app
+from licksterr.models import db, Measure, MeasureBeat, Beat, BeatNote, FormMeasure, FormNote, Note, Track, TrackMeasure
+from licksterr.queries import sync_forms
+from licksterr.storage import insert_ignore
+from licksterr.util import lazy_import
+
+np = lazy_import('numpy')
+logger = logging.getLogger(__name__)
+
+REMATCH_BATCH_SIZE = 500  # measures matched per transaction
+
+
+def rematch(form_ids, batch_size=REMATCH_BATCH_SIZE):
+    """
+    Adds the matches of the given forms to every measure matched at an older generation than the newest of them (see
+    NoteSet), then refreshes the form matches, timelines and form vectors of the tracks with any new match. Passes over
+    the measures are repeated until one finds no older measure, to catch the ones ingested meanwhile. Running it twice
+    adds nothing. Returns the ids of the refreshed tracks.
+    """
+    form_ids = np.array(sorted(set(form_ids)), dtype=np.int32)
+    if not len(form_ids):
+        return set()
+    generation = int(form_ids[-1])
+    words = (db.session.query(func.max(Note.id)).scalar() or 0) // 64 + 1
+    query = db.session.query(FormNote.form_id, FormNote.note_id).filter(FormNote.form_id.in_(form_ids.tolist()))
+    form_masks = get_masks(query.all(), {form_id: i for i, form_id in enumerate(form_ids.tolist())}, words)
+    older = db.or_(Measure.form_generation.is_(None), Measure.form_generation < generation)
+    tracks = set()
+    measures = 0
+    while True:
+        walked = 0
+        last_id = ''
+        while True:
+            batch = db.session.query(Measure.id, Measure.form_ids, Measure.form_matches) \
+                .filter(Measure.id > last_id, older).order_by(Measure.id).limit(batch_size).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            ids = [measure.id for measure in batch]
+            matched = store_matches(batch, match_measures(ids, form_ids, form_masks), form_ids)
+            db.session.query(Measure).filter(Measure.id.in_(ids), older) \
+                .update({'form_generation': generation}, synchronize_session=False)
+            if matched:
+                tracks.update(track_id for track_id, in db.session.query(TrackMeasure.track_id)
+                              .filter(TrackMeasure.measure_id.in_(matched)).distinct())
+            db.session.commit()
+            walked += len(batch)
+            measures += len(matched)
+        if not walked:
+            break
+    logger.info(f"Matched {measures} measures against {len(form_ids)} forms.")
+    refresh_tracks(tracks)
+    return tracks
+
+
+def get_masks(pairs, rows, words):
+    """
+    Bitmasks of the note ids of sets of notes, given (set, note id) pairs and the row of each set: bit n of word w is
+    set if the note with id 64 * w + n is in the set.
+    """
+    masks = np.zeros((len(rows), words), dtype=np.uint64)
+    if pairs:
+        owners, note_ids = zip(*pairs)
+        note_ids = np.array(note_ids, dtype=np.int64)
+        bits = np.left_shift(np.uint64(1), (note_ids % 64).astype(np.uint64))
+        np.bitwise_or.at(masks, (np.array([rows[owner] for owner in owners]), note_ids // 64), bits)
+    return masks
+
+
+def match_measures(measure_ids, form_ids, form_masks):
+    """
+    Returns the (measures x forms) matrix of the match of each form with each of the given measures: the share of the
+    ticks of the beats with notes whose notes are all in the form, as in Measure.get_or_create.
+    """
+    rows = db.session.query(MeasureBeat.measure_id, MeasureBeat.beat_id, MeasureBeat.indexes, Beat.ticks) \
+        .join(Beat, Beat.id == MeasureBeat.beat_id).filter(MeasureBeat.measure_id.in_(measure_ids)).all()
+    beat_rows = {beat_id: i for i, beat_id in enumerate({row.beat_id for row in rows})}
+    pairs = db.session.query(BeatNote.beat_id, BeatNote.note_id) \
+        .join(MeasureBeat, MeasureBeat.beat_id == BeatNote.beat_id) \
+        .filter(MeasureBeat.measure_id.in_(measure_ids)).distinct().all()
+    beat_masks = get_masks(pairs, beat_rows, form_masks.shape[1])
+    # a beat is in a form if none of its notes is outside of it
+    contained = ~(beat_masks[:, None, :] & ~form_masks[None, :, :]).any(axis=2) & beat_masks.any(axis=1)[:, None]
+    measure_rows = {measure_id: i for i, measure_id in enumerate(measure_ids)}
+    measure_rows = np.array([measure_rows[row.measure_id] for row in rows], dtype=np.int64)
+    beat_rows = np.array([beat_rows[row.beat_id] for row in rows], dtype=np.int64)
+    ticks = np.array([row.ticks * len(row.indexes) for row in rows], dtype=np.float64) * \
+        beat_masks.any(axis=1)[beat_rows]
+    matches = np.zeros((len(measure_ids), len(form_ids)))
+    np.add.at(matches, measure_rows, contained[beat_rows] * ticks[:, None])
+    totals = np.bincount(measure_rows, ticks, minlength=len(measure_ids))
+    return matches / np.where(totals > 0, totals, 1)[:, None]
+
+
+def store_matches(measures, matches, form_ids):
+    """Stores the non-zero matches the same way as each measure was stored. Returns the ids of the measures matched."""
+    rows = []
+    matched = []
+    for measure, measure_matches in zip(measures, matches):
+        found = np.flatnonzero(measure_matches)
+        if not len(found):
+            continue
+        matched.append(measure.id)
+        new_matches = {int(form_ids[i]): float(measure_matches[i]) for i in found}
+        if measure.form_ids is None:
+            rows.extend({'form_id': form_id, 'measure_id': measure.id, 'match': match}
+                        for form_id, match in new_matches.items())
+        else:
+            old_ids, old_matches = Measure.unpack_form_matches(measure.form_ids, measure.form_matches)
+            packed_ids, packed_matches = Measure.pack_form_matches({**new_matches, **dict(zip(
+                old_ids.tolist(), old_matches.tolist()))})
+            db.session.query(Measure).filter_by(id=measure.id) \
+                .update({'form_ids': packed_ids, 'form_matches': packed_matches}, synchronize_session=False)
+    if rows:
+        insert_ignore(db.session, FormMeasure.__table__, rows)
+    return matched
+
+
+def refresh_tracks(track_ids, batch_size=REMATCH_BATCH_SIZE):
+    """Computes again the form matches, the timeline and the form vector of the given tracks."""
+    track_ids = sorted(track_ids)
+    for i in range(0, len(track_ids), batch_size):
+        for track in Track.query.filter(Track.id.in_(track_ids[i:i + batch_size])):
+            track.set_keys(list(track.keys))
+            track.build_form_vector()
+        db.session.commit()
+    logger.info(f"Refreshed {len(track_ids)} tracks.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Matches the stored measures against new forms.")
+    parser.add_argument('--forms', type=lambda value: [int(id) for id in value.split(',')], default=None,
+                        help="ids of the forms to match, instead of the ones created for the new scales")
+    parser.add_argument('--batch-size', type=int, default=REMATCH_BATCH_SIZE, help="measures per transaction")
+    args = parser.parse_args()
+    setup_logging(to_file=False)
+    create_app()
+    form_ids = args.forms if args.forms is not None else sync_forms()
+    rematch(form_ids, batch_size=args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
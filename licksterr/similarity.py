@@ -0,0 +1,192 @@
+"""
+Finds the tracks that use the fretboard in a similar way, comparing their form vectors (see Track.build_form_vector)
+with the cosine similarity. The vectors of the library are kept in a memory-mapped index, rebuilt periodically with:
+python -m licksterr.similarity [--clusters N]
+Tracks added after the index was built are compared directly, so the index only has to be reasonably recent.
+"""
+import argparse
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+from flask import current_app
+
+from licksterr.models import db, Form, Track
+from licksterr.util import lazy_import
+
+np = lazy_import('numpy')
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = Path(os.path.realpath(__file__)).parents[1]
+INDEX_DIR = PROJECT_ROOT / "assets" / "similarity"
+COARSE_MIN_TRACKS = 10000  # smaller libraries are scanned entirely at every search
+DEFAULT_PROBES = 8  # clusters of the coarse index scored by a search
+MAX_SIMILAR = 100  # tracks a search can ask for
+OVERSAMPLING = 4  # candidates taken from the index for each result, scored again with the stored vectors
+SCAN_ROWS = 65536  # rows of the index multiplied at once
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def kmeans(vectors, clusters, iterations=10, sample_size=256, seed=0):
+    """
+    Spherical k-means over normalized vectors. Centroids are fitted on a sample of sample_size vectors per cluster,
+    then every vector is assigned to its closest centroid. Returns the centroids and the cluster of each vector.
+    """
+    rng = np.random.RandomState(seed)
+    sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), clusters * sample_size), replace=False))]
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)]
+    for _ in range(iterations):
+        labels = (sample @ centroids.T).argmax(axis=1)
+        for cluster in range(clusters):
+            members = sample[labels == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    labels = np.concatenate([(vectors[i:i + SCAN_ROWS] @ centroids.T).argmax(axis=1)
+                             for i in range(0, len(vectors), SCAN_ROWS)])
+    return centroids, labels
+
+
+class SimilarityIndex:
+    """
+    Normalized form vectors of the library saved as .npy files and memory-mapped, so that the workers share the same
+    pages and a search reads only the rows it scores. Above COARSE_MIN_TRACKS the rows are grouped by k-means cluster
+    and a search scores only the clusters whose centroids are closest to the query.
+    Every build goes in a new directory, and the 'current' file points to the latest one.
+    """
+    FILES = ('vectors', 'track_ids', 'centroids', 'offsets')
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.vectors = np.load(self.path / 'vectors.npy', mmap_mode='r')
+        self.track_ids = np.load(self.path / 'track_ids.npy')
+        self.centroids = np.load(self.path / 'centroids.npy')
+        # rows of cluster c are in offsets[c]:offsets[c + 1]
+        self.offsets = np.load(self.path / 'offsets.npy')
+        self.last_id = int(self.track_ids.max(initial=0))
+
+    @classmethod
+    def build(cls, path=INDEX_DIR, clusters=None):
+        form_ids = Form.get_ids()
+        query = db.session.query(Track.id, Track.form_vector).filter(Track.form_vector.isnot(None)).order_by(Track.id)
+        track_ids, vectors = [], []
+        for row in query.yield_per(1000):
+            track_ids.append(row.id)
+            vectors.append(Track.unpack_form_vector(row.form_vector, len(form_ids)))
+        vectors = normalize(np.array(vectors, dtype=np.float32).reshape(-1, len(form_ids)))
+        track_ids = np.array(track_ids, dtype=np.int64)
+        if not len(track_ids):
+            logger.info("No form vectors to index.")
+            return None
+        if clusters is None:
+            clusters = int(np.sqrt(len(vectors))) if len(vectors) >= COARSE_MIN_TRACKS else 1
+        clusters = min(clusters, len(vectors))
+        if clusters > 1:
+            centroids, labels = kmeans(vectors, clusters)
+            order = np.argsort(labels, kind='stable')
+            vectors, track_ids = vectors[order], track_ids[order]
+            offsets = np.searchsorted(labels[order], np.arange(clusters + 1))
+        else:
+            centroids, offsets = np.zeros((0, len(form_ids)), dtype=np.float32), np.array([0, len(vectors)])
+        path = Path(path)
+        build = path / str(int(time.time() * 1000))
+        build.mkdir(parents=True)
+        for name, values in zip(cls.FILES, (vectors, track_ids, centroids, offsets)):
+            np.save(build / f'{name}.npy', values)
+        (path / 'current.tmp').write_text(build.name)
+        os.replace(path / 'current.tmp', path / 'current')
+        # searches still reading the previous build keep their memory maps open
+        for old in path.iterdir():
+            if old.is_dir() and old != build:
+                shutil.rmtree(old, ignore_errors=True)
+        logger.info(f"Built similarity index of {len(vectors)} tracks in {max(clusters, 1)} cluster(s).")
+        return cls(build)
+
+    def search(self, vector, k, probes=DEFAULT_PROBES):
+        """Returns the ids of the k indexed tracks whose vectors are the closest to the normalized vector."""
+        vector = vector[:self.vectors.shape[1]]
+        if len(self.centroids):
+            clusters = np.argsort(-(self.centroids @ vector))[:probes]
+            ranges = [(self.offsets[c], self.offsets[c + 1]) for c in clusters]
+        else:
+            ranges = [(start, min(start + SCAN_ROWS, len(self.vectors)))
+                      for start in range(0, len(self.vectors), SCAN_ROWS)]
+        scores = np.concatenate([self.vectors[start:end] @ vector for start, end in ranges] or [np.zeros(0)])
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges] or [np.zeros(0, dtype=np.int64)])
+        if len(scores) > k:
+            best = np.argpartition(-scores, k)[:k]
+            rows = rows[best]
+        return self.track_ids[rows].tolist()
+
+
+_INDEXES = {}
+
+
+def get_index():
+    """Returns the latest index built in SIMILARITY_DIR, or None if there is none."""
+    path = Path(current_app.config.get('SIMILARITY_DIR', INDEX_DIR))
+    try:
+        build = path / (path / 'current').read_text()
+    except FileNotFoundError:
+        return None
+    if _INDEXES.get(path) is None or _INDEXES[path].path != build:
+        _INDEXES[path] = SimilarityIndex(build)
+    return _INDEXES[path]
+
+
+def find_similar(track, k=10, probes=DEFAULT_PROBES):
+    """
+    Returns the k tracks most similar to the given one, as dicts with the track and song ids and the similarity.
+    Candidates come from the index and from the tracks added after it was built, and are all scored again with their
+    stored vectors, so that tracks deleted or changed since the build are never reported with stale scores.
+    """
+    size = len(Form.get_ids())
+    vector = normalize(Track.unpack_form_vector(track.form_vector, size))
+    query = db.session.query(Track.id, Track.song_id, Track.form_vector) \
+        .filter(Track.form_vector.isnot(None), Track.id != track.id)
+    index = get_index()
+    if index:
+        candidates = index.search(vector, k * OVERSAMPLING + 1, probes)
+        query = query.filter(db.or_(Track.id.in_(candidates), Track.id > index.last_id))
+    rows = query.all()
+    if not rows:
+        return []
+    scores = normalize(np.stack([Track.unpack_form_vector(row.form_vector, size) for row in rows])) @ vector
+    return [{'track': rows[i].id, 'song': rows[i].song_id, 'similarity': round(float(scores[i]), 4)}
+            for i in np.argsort(-scores, kind='stable')[:k]]
+
+
+def backfill_form_vectors(batch_size=500):
+    """Builds the form vectors of the tracks analyzed before they were introduced."""
+    while True:
+        tracks = Track.query.filter(Track.form_vector.is_(None)).order_by(Track.id).limit(batch_size).all()
+        if not tracks:
+            break
+        for track in tracks:
+            track.build_form_vector()
+        db.session.commit()
+        logger.info(f"Built the form vectors of {len(tracks)} tracks.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the index of the form vectors used by the similarity search.")
+    parser.add_argument('--clusters', type=int, default=None,
+                        help=f"clusters of the coarse index (default: square root of the tracks if they are at least "
+                             f"{COARSE_MIN_TRACKS}, otherwise no coarse index)")
+    args = parser.parse_args()
+    # the package imports this module through the song blueprint
+    from licksterr import setup_logging, create_app
+    setup_logging(to_file=False)
+    app = create_app()
+    backfill_form_vectors()
+    SimilarityIndex.build(app.config.get('SIMILARITY_DIR', INDEX_DIR), clusters=args.clusters)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,42 @@
 import json
 import os
-import struct
 
-import guitarpro as gp
-from flask import Blueprint, request, current_app, jsonify, abort
+from flask import Blueprint, Response, request, current_app, jsonify, abort, stream_with_context
 
-from licksterr.analysis import parse_song, logger
+from licksterr.analysis import parse_song, redetect_keys, logger
 from licksterr.exceptions import BadTabException
-from licksterr.models import Song, Track, Measure
+from licksterr.metrics import ANALYSIS_QUEUE
+from licksterr.models import Song, Track, Measure, KEYS, MEASURE_BATCH_SIZE
 from licksterr.models import db
-from licksterr.util import flask_file_handler, OK
+from licksterr.similarity import find_similar, MAX_SIMILAR
+from licksterr.util import admission_control, flask_file_handler, parse_upload, OK
 
 song = Blueprint('song', __name__)
 
 
 @song.route('/upload', methods=['POST'])
 @flask_file_handler
-def upload_file(file, temp_dest):
+@admission_control
+@parse_upload
+@ANALYSIS_QUEUE.track_inprogress
+def upload_file(file, content, tab):
     tracks = request.values.get('tracks', None)
     tracks = json.loads(tracks) if tracks else None
     try:
-        song = parse_song(temp_dest, tracks=[int(track) for track in tracks])
+        song = parse_song(file.filename, tracks=[int(track) for track in tracks], content=content, song=tab)
     except BadTabException:
         abort(400)
-    file.save(str(current_app.config['UPLOAD_DIR'] / (str(song.id))))
+    (current_app.config['UPLOAD_DIR'] / str(song.id)).write_bytes(content)
     logger.debug(f"Successfully parsed song {song}")
     return OK
 
 
 @song.route('/tabinfo', methods=['POST'])
 @flask_file_handler
-def get_tab_info(file, temp_dest):
-    try:
-        song = gp.parse(temp_dest)
-    except struct.error:
-        abort(400)
-    return jsonify({i: track.name for i, track in enumerate(song.tracks) if len(track.strings) == 6})
+@admission_control
+@parse_upload
+def get_tab_info(file, content, tab):
+    return jsonify({i: track.name for i, track in enumerate(tab.tracks) if len(track.strings) == 6})
 
 
 @song.route('/songs/<song_id>', methods=['GET'])
@@ -46,26 +47,57 @@ def get_song(song_id):
     return jsonify(song.to_dict())
 
 
-@song.route('/tracks/<track_id>/keys/<key_id>', methods=['PUT'])
+@song.route('/tracks/keys', methods=['POST'])
+def redetect_track_keys():
+    """
+    Runs the key detection again with new parameters. The JSON body can hold 'tracks' (list of ids, all tracks if
+    missing), 'penalty' and 'flat' (see KeyFinder).
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        abort(400)
+    tracks = data.get('tracks')
+    params = {param: data[param] for param in ('penalty', 'flat') if param in data}
+    if 'penalty' in params and (isinstance(params['penalty'], bool) or not isinstance(params['penalty'], (int, float))
+                                or not 0 <= params['penalty'] < float('inf')):
+        abort(400)
+    if 'flat' in params and not isinstance(params['flat'], bool):
+        abort(400)
+    if tracks is not None and not isinstance(tracks, list):
+        abort(400)
+    try:
+        track_ids = [int(track) for track in tracks] if tracks is not None else None
+    except (TypeError, ValueError):
+        abort(400)
+    results = redetect_keys(track_ids=track_ids, **params)
+    return jsonify(results)
+
+
+@song.route('/tracks/<track_id>/keys/<int:key_id>', methods=['PUT'])
 def add_track_key(track_id, key_id):
-    Track.query.get(track_id).add_key(key_id)
+    track = Track.query.get(track_id)
+    if not track or not 0 <= key_id < len(KEYS):
+        abort(404)
+    track.add_key(key_id)
     db.session.commit()
     return OK
 
 
-@song.route('/tracks/<track_id>/keys/<key_id>', methods=['DELETE'])
+@song.route('/tracks/<track_id>/keys/<int:key_id>', methods=['DELETE'])
 def remove_track_key(track_id, key_id):
-    Track.query.get(track_id).remove_key(key_id)
+    track = Track.query.get(track_id)
+    if not track:
+        abort(404)
+    track.remove_key(key_id)
     db.session.commit()
     return OK
 
 
 @song.route('/songs/<song_id>', methods=['DELETE'])
 def remove_song(song_id):
-    song = Song.query.get(song_id)
-    if not song:
+    # a single DELETE, tracks and their rows are removed by the database with the cascading foreign keys
+    if not Song.query.filter_by(id=song_id).delete(synchronize_session=False):
         abort(404)
-    db.session.delete(song)
     os.remove(current_app.config['UPLOAD_DIR'] / str(song_id))
     logger.debug("Removed file at temporary destination.")
     db.session.commit()
@@ -80,6 +112,56 @@ def get_track(track_id):
     return jsonify(track.to_dict())
 
 
+@song.route('/tracks/<track_id>/timeline', methods=['GET'])
+def get_track_timeline(track_id):
+    """Forms matched by the track in windows of 'window' measures, from measure 'start' to measure 'end' excluded."""
+    track = Track.query.get(track_id)
+    # timelines are built when the track is analyzed or its keys change, see licksterr.migrations for older tracks
+    if not track or track.timeline is None:
+        abort(404)
+    start = request.args.get('start', 0, type=int)
+    end = request.args.get('end', None, type=int)
+    window = request.args.get('window', 1, type=int)
+    return jsonify(track.get_timeline(start=start, end=end, window=window))
+
+
+@song.route('/tracks/<track_id>/measures', methods=['GET'])
+def get_track_measures(track_id):
+    """
+    All the measures of the track in playback order (see Track.iter_measures), streamed as a JSON list as they are
+    fetched. Measures repeated close to each other are serialized once.
+    """
+    track = Track.query.get(track_id)
+    if not track:
+        abort(404)
+
+    def generate():
+        serialized = {}
+        yield '['
+        for i, measure in enumerate(track.iter_measures()):
+            if len(serialized) > MEASURE_BATCH_SIZE:
+                serialized.clear()
+            if measure['id'] not in serialized:
+                serialized[measure['id']] = json.dumps(measure)
+            yield (',' if i else '') + serialized[measure['id']]
+        yield ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@song.route('/tracks/<track_id>/similar', methods=['GET'])
+def get_similar_tracks(track_id):
+    """The 'k' tracks (10 by default, at most MAX_SIMILAR) that use the same forms as this one the most."""
+    k = request.args.get('k', 10, type=int)
+    if not 1 <= k <= MAX_SIMILAR:
+        abort(400)
+    track = Track.query.get(track_id)
+    # form vectors are built when the track is analyzed, see licksterr.migrations for older tracks
+    if not track or track.form_vector is None:
+        abort(404)
+    return jsonify(find_similar(track, k=k))
+
+
 @song.route('/measures/<measure_id>', methods=['GET'])
 def get_measure(measure_id):
     measure = Measure.query.get(measure_id)
@@ -0,0 +1,163 @@
+import sqlite3
+import struct
+from collections import defaultdict
+
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm, select, Integer, LargeBinary
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.types import TypeDecorator
+
+REPLICA_BIND = 'replica'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Defaults of the connection pool settings read by configure_database
+POOL_DEFAULTS = {
+    'DB_POOL_SIZE': 10,
+    'DB_MAX_OVERFLOW': 20,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+}
+# deadlock detected, serialization failure, unique violation
+TRANSIENT_PGCODES = ('40P01', '40001', '23505')
+
+
+class IntArray(TypeDecorator):
+    """
+    List of integers. Postgres stores it in a native ARRAY column, every other backend gets a blob of packed
+    little-endian 32 bit integers.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(ARRAY(Integer))
+        return dialect.type_descriptor(LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return pack_ints(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return unpack_ints(value)
+
+
+def pack_ints(values):
+    return struct.pack(f'<{len(values)}i', *values)
+
+
+def unpack_ints(blob):
+    return list(struct.unpack(f'<{len(blob) // 4}i', blob))
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """WAL lets the readers go on while an upload is being written, and SQLite ignores foreign keys by default."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends the queries of read-only (GET) requests to the replica database, if one is configured. Flushes, writes and
+    everything that happens outside of such requests (uploads, background jobs) go to the primary.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase) or not self.use_replica():
+            return super().get_bind(mapper, clause)
+        return self.db.get_engine(self.app, bind=REPLICA_BIND)
+
+    def use_replica(self):
+        return REPLICA_BIND in (self.app.config['SQLALCHEMY_BINDS'] or {}) and \
+               has_request_context() and request.method in SAFE_METHODS
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def clear_written_keys(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('written_keys', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def configure_database(config):
+    """
+    Fills the Flask-SQLAlchemy engine options from the pool settings (see POOL_DEFAULTS) and adds the bind of the read
+    replica when SQLALCHEMY_REPLICA_URI is set. Options already in SQLALCHEMY_ENGINE_OPTIONS are kept.
+    """
+    settings = {key: config.get(key, default) for key, default in POOL_DEFAULTS.items()}
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options.setdefault('pool_pre_ping', settings['DB_POOL_PRE_PING'])
+    options.setdefault('pool_recycle', settings['DB_POOL_RECYCLE'])
+    if not config.get('SQLALCHEMY_DATABASE_URI', 'sqlite://').startswith('sqlite'):
+        # SQLite opens a connection per use, it has no pool to size
+        options.setdefault('pool_size', settings['DB_POOL_SIZE'])
+        options.setdefault('max_overflow', settings['DB_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', settings['DB_POOL_TIMEOUT'])
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    replica = config.get('SQLALCHEMY_REPLICA_URI')
+    if replica:
+        config['SQLALCHEMY_BINDS'] = {**(config.get('SQLALCHEMY_BINDS') or {}), REPLICA_BIND: replica}
+
+
+def insert_ignore(session, table, rows):
+    """
+    Inserts the rows of the table, skipping the ones whose primary key already exists, even when another transaction
+    is inserting them at the same time: it waits for that transaction to end instead of failing. Returns the number of
+    rows inserted, which is reliable only for a single row.
+    """
+    statement = table.insert()
+    dialect = session.get_bind(clause=statement).dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        statement = statement.prefix_with('OR IGNORE')
+    return session.execute(statement, rows).rowcount
+
+
+def lock_for_reuse(session, table, id):
+    """
+    Locks the row with the given primary key against deletes until the end of the transaction, so that the orphan
+    collection (see licksterr.cleanup) skips it while an upload is reusing it. Returns whether the row still exists.
+    Only Postgres locks rows: SQLite runs one writing transaction at a time, and the row is simply assumed to exist.
+    """
+    key = list(table.primary_key.columns)[0]
+    statement = select([key]).where(key == id).with_for_update(read=True, key_share=True)
+    if session.get_bind(clause=statement).dialect.name != 'postgresql':
+        return True
+    return session.execute(statement).first() is not None
+
+
+def written_keys(session, table):
+    """Primary keys of the table inserted or found by insert_ignore in the current transaction."""
+    return session.info.setdefault('written_keys', defaultdict(set))[table.name]
+
+
+def is_transient_error(error):
+    """Whether a transaction that failed with this DBAPIError can succeed if it's simply run again."""
+    # a unique violation means that another transaction committed the same row first, the retry will find it. Other
+    # integrity errors are bugs.
+    if getattr(error.orig, 'pgcode', None) in TRANSIENT_PGCODES:
+        return True
+    if isinstance(error.orig, sqlite3.IntegrityError):
+        return 'UNIQUE constraint failed' in str(error.orig)
+    return isinstance(error.orig, sqlite3.OperationalError) and 'locked' in str(error.orig)
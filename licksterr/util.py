@@ -1,15 +1,58 @@
+import importlib
+import io
 import json
 import logging
-import os
-import uuid
+import struct
+import sys
+import threading
+import types
 from functools import wraps
 from time import time
 
 from flask import request, abort, current_app
+from sqlalchemy import LargeBinary
+
+from licksterr.metrics import STAGE_SECONDS, UPLOADS_REJECTED
 
 logger = logging.getLogger(__name__)
 
 OK = json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
+GP_EXTENSIONS = ('.gp3', '.gp4', '.gp5')
+# Headers of the Guitar Pro versions that can be parsed. They don't always match the extension: some .gp5 files are
+# written in the format of Guitar Pro 4.
+GP_HEADERS = frozenset((
+    'FICHIER GUITAR PRO v3.00',
+    'FICHIER GUITAR PRO v4.00', 'FICHIER GUITAR PRO v4.06', 'FICHIER GUITAR PRO L4.06', 'CLIPBOARD GUITAR PRO 4.0 [c6]',
+    'FICHIER GUITAR PRO v5.00', 'FICHIER GUITAR PRO v5.10', 'CLIPBOARD GP 5.0', 'CLIPBOARD GP 5.1', 'CLIPBOARD GP 5.2',
+))
+# Defaults of the upload limits, see the MAX_* settings
+MAX_CONTENT_LENGTH = 2 * 1024 * 1024
+MAX_UPLOAD_TRACKS = 64
+MAX_CONCURRENT_ANALYSES = 4
+ANALYSIS_RETRY_AFTER = 5  # seconds suggested to the clients turned away by admission control
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stands for a module until one of its attributes is used, which imports it. The import goes through importlib,
+    whose lock makes the threads using the module for the first time at once wait until it is fully executed.
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        # the next lookups find the attributes without coming back here
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """
+    Returns the module, or a LazyModule standing for it if it wasn't imported yet. Keeps heavy libraries out of the
+    startup of the workers that never need them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
 
 
 def timing(f, level=logging.DEBUG, verbose=False):
@@ -25,7 +68,18 @@ def timing(f, level=logging.DEBUG, verbose=False):
     return wrap
 
 
+def reject(code, reason):
+    UPLOADS_REJECTED.labels(reason).inc()
+    logger.debug(f"Rejected upload: {reason}.")
+    abort(code)
+
+
 def flask_file_handler(f):
+    """
+    Reads the uploaded tab in memory and checks that its Guitar Pro header is of a supported version, before anything
+    is written. The size is capped by MAX_CONTENT_LENGTH. The wrapped view gets the file and its content, see
+    parse_upload.
+    """
     @wraps(f)
     def wrap(*args, **kw):
         if not request.files:
@@ -33,15 +87,64 @@ def flask_file_handler(f):
             abort(400)
         file = list(request.files.values())[0]
         extension = file.filename[-4:]
-        if extension not in {'.gp3', '.gp4', '.gp5'}:
-            abort(400)
-        temp_dest = str(current_app.config['TEMP_DIR'] / (str(uuid.uuid1()) + extension))
-        file.save(temp_dest)
-        logger.debug(f"temporarily uploaded to {temp_dest}.")
-        response = f(file, temp_dest, *args, **kw)
-        os.remove(temp_dest)
-        logger.debug("Removed file at temporary destination.")
-        return response
+        if extension not in GP_EXTENSIONS:
+            reject(400, 'extension')
+        content = file.read()
+        # the version is a string of up to 30 characters prefixed by its length
+        if not content or content[1:1 + content[0]].decode('latin-1') not in GP_HEADERS:
+            reject(400, 'header')
+        return f(file, content, *args, **kw)
+
+    return wrap
+
+
+def parse_upload(f):
+    """
+    Parses the content read by flask_file_handler, rejecting the tabs that can't be parsed or have more than
+    MAX_UPLOAD_TRACKS tracks. The wrapped view gets the parsed song too.
+    """
+    gp = lazy_import('guitarpro')
+
+    @wraps(f)
+    def wrap(file, content, *args, **kw):
+        try:
+            with STAGE_SECONDS.labels('gp_parse').time():
+                song = gp.parse(io.BytesIO(content))
+        # a tab with a valid header can still be truncated or garbled anywhere
+        except (struct.error, gp.GPException, ValueError, IndexError, EOFError):
+            reject(400, 'parse')
+        if len(song.tracks) > current_app.config.get('MAX_UPLOAD_TRACKS', MAX_UPLOAD_TRACKS):
+            reject(413, 'tracks')
+        return f(file, content, song, *args, **kw)
+
+    return wrap
+
+
+_analyses_lock = threading.Lock()
+
+
+def admission_control(f):
+    """
+    Runs at most MAX_CONCURRENT_ANALYSES calls at once in each process. Further calls are turned away right away with
+    429 and a Retry-After of ANALYSIS_RETRY_AFTER seconds, rather than queueing behind the running ones.
+    """
+    @wraps(f)
+    def wrap(*args, **kw):
+        with _analyses_lock:
+            slots = current_app.extensions.get('licksterr_analyses')
+            if slots is None:
+                slots = threading.BoundedSemaphore(
+                    current_app.config.get('MAX_CONCURRENT_ANALYSES', MAX_CONCURRENT_ANALYSES))
+                current_app.extensions['licksterr_analyses'] = slots
+        if not slots.acquire(blocking=False):
+            UPLOADS_REJECTED.labels('busy').inc()
+            retry_after = current_app.config.get('ANALYSIS_RETRY_AFTER', ANALYSIS_RETRY_AFTER)
+            return json.dumps({'success': False}), 429, {'ContentType': 'application/json',
+                                                         'Retry-After': str(retry_after)}
+        try:
+            return f(*args, **kw)
+        finally:
+            slots.release()
 
     return wrap
 
@@ -49,6 +152,8 @@ def flask_file_handler(f):
 def row2dict(row):
     d = {}
     for column in row.__table__.columns:
-        d[column.name] = getattr(row, column.name)
+        # packed columns aren't serializable
+        if not isinstance(column.type, LargeBinary):
+            d[column.name] = getattr(row, column.name)
 
     return d
@@ -6,9 +6,9 @@ from pathlib import Path
 
 import requests
 from flask_testing import LiveServerTestCase
-from sqlalchemy import text
 
 from licksterr import ASSETS_DIR, db, setup_logging, create_app
+from licksterr.migrations import upgrade
 
 TEST_ASSETS = Path(ASSETS_DIR) / "tests"
 
@@ -20,17 +20,19 @@ class LicksterrTest(LiveServerTestCase):
     def tearDown(self):
         db.session.remove()
         # keeps scales and notes created at startup
-        for table in db.metadata.tables:
-            if table not in ('form', 'note', 'form_note'):
-                db.engine.execute(text('DROP TABLE %s CASCADE' % table))
-        # deletes all files in temporary folder
+        for table in reversed(db.metadata.sorted_tables):
+            if table.name not in ('form', 'note', 'form_note'):
+                table.drop(db.engine, checkfirst=True)
+        # deletes all files in temporary folders
         files = glob.glob(str(self.app.config['UPLOAD_DIR'] / '*'))
+        files += glob.glob(str(self.app.config['PROFILING_DIR'] / '*'))
         for f in files:
             os.remove(f)
 
     def create_app(self):
         setup_logging(to_file=False, default_level=logging.DEBUG)
         app = create_app(config='tests.config')
+        upgrade()
         self.logger = logging.getLogger(__name__)
         return app
 
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 TESTING = True
@@ -17,4 +18,10 @@ DB_IP = 'localhost'
 DB_PORT = 5432
 DB_DB = 'licksterr-test'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-SQLALCHEMY_DATABASE_URI = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_IP}:{DB_PORT}/{DB_DB}"
+# Set TEST_DATABASE_URI (e.g. sqlite:////tmp/licksterr-test.db) to run the suite without a Postgres server
+SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URI',
+                                    f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_IP}:{DB_PORT}/{DB_DB}")
+
+PROFILING_ENABLED = True
+PROFILING_DIR = Path(tempfile.gettempdir()) / "licksterr-test-profiles"
+PROFILING_TOKEN = 'test'
@@ -1,9 +1,15 @@
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
-from licksterr.models import Measure, Song, Track, Beat
-from tests import LicksterrTest
+from licksterr.cleanup import collect_orphans
+from licksterr import db
+from licksterr.models import Measure, Song, Track, Beat, FormMeasure, TrackForm
+from licksterr.rematch import rematch
+from licksterr.similarity import SimilarityIndex, normalize
+from tests import LicksterrTest, TEST_ASSETS
 
 
 class FlaskTest(LicksterrTest):
@@ -26,10 +32,35 @@ class FlaskTest(LicksterrTest):
         files = [name for name in os.listdir(self.app.config['UPLOAD_DIR'])]
         self.assertEqual(1, len(files))
 
+    def test_concurrent_upload(self):
+        # the songs can share beats and measures, which are inserted by whichever upload comes first
+        files = ("ks_test_0.gp5", "ks_test_1.gp5", "test.gp5")
+        with ThreadPoolExecutor(len(files)) as executor:
+            responses = list(executor.map(self.upload_file, files))
+        self.assertEqual([200] * len(files), [response.status_code for response in responses])
+        self.assertEqual(len(files), len(Song.query.all()))
+
+    def test_concurrent_same_upload(self):
+        # every upload but the first to commit conflicts on the song, its beats and its measure, and finds the song
+        with ThreadPoolExecutor(3) as executor:
+            responses = list(executor.map(lambda _: self.upload_file(), range(3)))
+        self.assertEqual([200] * 3, [response.status_code for response in responses])
+        self.assertEqual(1, len(Song.query.all()))
+        self.assertEqual(1, len(Measure.query.all()))
+        self.assertEqual(4, len(Beat.query.all()))
+
     def test_wrong_file(self):
         response = self.upload_file("wrong_file.gp5")
         self.assertEqual(400, response.status_code)
 
+    def test_wrong_header(self):
+        content = (TEST_ASSETS / "test.gp5").read_bytes().replace(b'GUITAR PRO v5', b'GUITAR PRO v9', 1)
+        response = requests.post(self.get_server_url() + "/upload", files={'test.gp5': content}, data={'tracks': '[0]'})
+        self.assertEqual(400, response.status_code)
+        response = requests.post(self.get_server_url() + "/tabinfo", files={'test.gp5': b'\x05hello' + content[6:]})
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(Song.query.all())
+
     def test_song_delete(self):
         self.upload_file()
         delete_url = self.get_server_url() + '/songs/1'
@@ -38,3 +69,110 @@ class FlaskTest(LicksterrTest):
         self.assertFalse(Track.query.all())
         files = [name for name in os.listdir(self.app.config['UPLOAD_DIR'])]
         self.assertEqual(0, len(files))
+
+    def test_orphan_collection(self):
+        self.upload_file()
+        self.assertEqual((0, 0), collect_orphans())
+        requests.delete(self.get_server_url() + '/songs/1')
+        db.session.expire_all()
+        self.assertEqual((1, 4), collect_orphans(batch_size=2))
+        self.assertFalse(Measure.query.all())
+        self.assertFalse(Beat.query.all())
+        self.assertFalse(FormMeasure.query.all())
+
+    def test_rematch(self):
+        self.upload_file()
+        form_matches = {(fm.form_id, fm.measure_id): fm.match for fm in FormMeasure.query.all()}
+        track_forms = {tf.form_id: tf.match for tf in TrackForm.query.all()}
+        # as if the forms had been added after the upload
+        FormMeasure.query.delete()
+        TrackForm.query.delete()
+        Measure.query.update({'form_generation': 0})
+        db.session.commit()
+        self.assertEqual({1}, rematch({form_id for form_id, _ in form_matches}))
+        self.assertEqual(form_matches.keys(), {(fm.form_id, fm.measure_id) for fm in FormMeasure.query.all()})
+        for fm in FormMeasure.query.all():
+            self.assertAlmostEqual(form_matches[(fm.form_id, fm.measure_id)], fm.match, places=5)
+        self.assertEqual(track_forms.keys(), {tf.form_id for tf in TrackForm.query.all()})
+        self.assertEqual(set(), rematch({form_id for form_id, _ in form_matches}))
+
+    def test_metrics(self):
+        self.upload_file()
+        text = requests.get(self.get_server_url() + '/metrics').text
+        self.assertIn('licksterr_stage_seconds_count{stage="gp_parse"} 1', text)
+        self.assertIn('licksterr_cache_lookups_total{entity="beat",result="hit"}', text)
+        self.assertIn('licksterr_analysis_queue_depth 0.0', text)
+
+    def test_similar(self):
+        for filename in ("ks_test_0.gp5", "ks_test_1.gp5", "test.gp5"):
+            self.upload_file(filename)
+        url = self.get_server_url() + "/tracks/1/similar"
+        json = requests.get(url).json()
+        self.assertEqual({2, 3}, {result['track'] for result in json})
+        self.assertGreaterEqual(json[0]['similarity'], json[1]['similarity'])
+        self.assertEqual(json[:1], requests.get(url, params={'k': 1}).json())
+        self.assertEqual(400, requests.get(url, params={'k': 0}).status_code)
+        self.assertEqual(400, requests.get(url, params={'k': 1000}).status_code)
+        with tempfile.TemporaryDirectory() as path:
+            index = SimilarityIndex.build(path)
+            self.assertEqual([1], index.search(normalize(Track.unpack_form_vector(
+                Track.query.get(1).form_vector, index.vectors.shape[1])), k=1))
+
+    def test_track_measures(self):
+        self.upload_file()
+        measures = requests.get(self.get_server_url() + "/tracks/1/measures").json()
+        timeline = requests.get(self.get_server_url() + "/tracks/1/timeline").json()
+        self.assertEqual(timeline['measures'], len(measures))
+        self.assertEqual(measures[0], measures[1])
+        self.assertEqual(measures, list(Track.query.get(1).iter_measures(batch_size=1)))
+        measure = requests.get(self.get_server_url() + f"/measures/{measures[0]['id']}").json()
+        beats = sorted((i, beat['ticks'], len(beat['notes'])) for beat in measure['beats'] for i in beat['indexes'])
+        self.assertEqual([(beat['ticks'], len(beat['notes'])) for beat in measures[0]['beats']],
+                         [beat[1:] for beat in beats])
+
+    def test_export(self):
+        self.upload_file()
+        response = requests.get(self.get_server_url() + "/export/track_form", params={'batch_size': 2})
+        rows = response.text.splitlines()
+        self.assertEqual('track_id,song_id,form_id,key,scale,name,match', rows[0])
+        self.assertEqual(TrackForm.query.count(), len(rows) - 1)
+        rows = requests.get(self.get_server_url() + "/export/track_keys").text.splitlines()
+        self.assertEqual(len(Track.query.get(1).keys), len(rows) - 1)
+        self.assertEqual(404, requests.get(self.get_server_url() + "/export/song").status_code)
+        self.assertEqual(400, requests.get(self.get_server_url() + "/export/track_form",
+                                           params={'batch_size': 0}).status_code)
+
+    def test_profiling(self):
+        self.upload_file()
+        url = self.get_server_url()
+        token = {'X-Profile-Token': self.app.config['PROFILING_TOKEN']}
+        response = requests.get(url + "/tracks/1", headers={'X-Profile': 'cprofile'})
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(403, requests.get(url + "/admin/profiles").status_code)
+        response = requests.get(url + "/tracks/1", headers={'X-Profile': 'cprofile', **token})
+        profile_id = response.headers['X-Profile-Id']
+        profiles = requests.get(url + "/admin/profiles", headers=token).json()
+        self.assertEqual('GET /tracks/1', next(p for p in profiles if p['id'] == profile_id)['target'])
+        text = requests.get(url + f"/admin/profiles/{profile_id}", params={'format': 'text'}, headers=token).text
+        self.assertIn('get_track', text)
+        response = requests.get(url + "/tracks/1", headers={'X-Profile': 'sample', **token})
+        self.assertEqual(200, requests.get(url + "/admin/profiles/" + response.headers['X-Profile-Id'],
+                                           headers=token).status_code)
+
+    def test_key_timeline(self):
+        self.upload_file()
+        key = Track.query.get(1).keys[0]
+        url = self.get_server_url() + "/tracks/1"
+        self.assertEqual(200, requests.delete(url + f"/keys/{key}").status_code)
+        self.assertFalse(any(w['forms'] for w in requests.get(url + "/timeline").json()['windows']))
+        self.assertEqual(200, requests.put(url + f"/keys/{key}").status_code)
+        self.assertTrue(any(w['forms'] for w in requests.get(url + "/timeline").json()['windows']))
+
+    def test_timeline(self):
+        self.upload_file()
+        url = self.get_server_url() + "/tracks/1/timeline"
+        json = requests.get(url, params={'window': 2}).json()
+        self.assertEqual((json['measures'] + 1) // 2, len(json['windows']))
+        self.assertTrue(json['windows'][0]['forms'])
+        json = requests.get(url, params={'start': 1, 'end': 2}).json()
+        self.assertEqual([{'start': 1, 'end': 2}], [{k: w[k] for k in ('start', 'end')} for w in json['windows']])
@@ -1,8 +1,12 @@
+import json
 import os
+import tempfile
+from pathlib import Path
 
 from PIL import ImageColor
 
-from licksterr.image import GuitarImage
+from licksterr.image import GuitarImage, load_charts, render_charts
+from licksterr.models import Scale
 from tests import TEST_ASSETS, LicksterrTest
 
 
@@ -21,3 +25,12 @@ class TestImage(LicksterrTest):
                 color = 'red' if note == 'E' else 'green'
                 self.guitar.fill_note(string, fret, ImageColor.getcolor(color, mode='RGBA'), im=im)
         im.save(os.path.join(TEST_ASSETS, "test_fill.png"))
+
+    def test_render_charts(self):
+        charts = load_charts(keys=[0], scales=[Scale.IONIAN, Scale.AEOLIAN], separate=True)
+        self.assertEqual(10, len(charts))
+        with tempfile.TemporaryDirectory() as output:
+            index = render_charts(charts, output, Path(output) / 'atlas.png', workers=2)
+            self.assertTrue((Path(output) / 'Ionian' / 'C_A.png').exists())
+            self.assertEqual({chart.name for chart in charts}, set(index))
+            self.assertEqual(index, json.loads((Path(output) / 'atlas.json').read_text()))
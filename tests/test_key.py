@@ -1,6 +1,8 @@
 import requests
 
-from tests import LicksterrTest
+from licksterr.analysis import parse_song
+from licksterr.models import FormMeasure, Measure, FORM_MATCH_PACKED
+from tests import LicksterrTest, TEST_ASSETS
 
 
 class FlaskTest(LicksterrTest):
@@ -17,8 +19,26 @@ class FlaskTest(LicksterrTest):
     def test_mad_world(self):
         self.match_scale("mad_world.gp5", 2, 'F', False, 'DORIAN')
 
+    def test_redetect(self):
+        self.upload_file("ks_test_0.gp5")
+        url = self.get_server_url() + "/tracks/keys"
+        json = requests.post(url, json={'tracks': [1], 'penalty': 0.5}).json()
+        self.assertEqual([0], json['1'])
+        self.assertEqual(400, requests.post(url, json={'penalty': 'high'}).status_code)
+        self.assertEqual(400, requests.post(url, json={'flat': 1}).status_code)
+        self.assertEqual(400, requests.post(url, json={'tracks': '12'}).status_code)
+        self.assertEqual({}, requests.post(url, json={'tracks': []}).json())
+
+    def test_packed_storage(self):
+        self.app.config['FORM_MATCH_STORAGE'] = FORM_MATCH_PACKED
+        parse_song(str(TEST_ASSETS / "wish_you_were_here.gp5"), tracks=[2])
+        self.assertFalse(FormMeasure.query.all())
+        self.assertTrue(all(measure.form_ids is not None for measure in Measure.query.all()))
+        self.match_scale(None, 2, 'G', True, 'IONIAN')
+
     def match_scale(self, filename, track, key, is_major, scale):
-        self.upload_file(filename, tracks=[track])
+        if filename:
+            self.upload_file(filename, tracks=[track])
         url = self.get_server_url() + f"/tracks/1"
         json = requests.get(url).json()
         d = json['match'][0]
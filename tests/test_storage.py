@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+
+from flask import Flask
+from sqlalchemy import Column, MetaData, String, Table, select
+
+from licksterr.storage import REPLICA_BIND, RoutingSQLAlchemy, configure_database
+
+source = Table('source', MetaData(), Column('name', String))
+
+
+class RoutingTest(unittest.TestCase):
+    """Reads and writes against two SQLite files, each holding the name of its database."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{self.dir.name}/primary.db"
+        self.app.config['SQLALCHEMY_REPLICA_URI'] = f"sqlite:///{self.dir.name}/replica.db"
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        configure_database(self.app.config)
+        self.db = RoutingSQLAlchemy(self.app)
+        with self.app.app_context():
+            for bind, name in ((None, 'primary'), (REPLICA_BIND, 'replica')):
+                engine = self.db.get_engine(self.app, bind=bind)
+                source.create(engine)
+                engine.execute(source.insert(), {'name': name})
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.db.session.remove()
+            for bind in (None, REPLICA_BIND):
+                self.db.get_engine(self.app, bind=bind).dispose()
+        self.dir.cleanup()
+
+    def read(self):
+        return self.db.session.execute(select([source.c.name])).scalar()
+
+    def test_get_reads_replica(self):
+        with self.app.test_request_context(method='GET'):
+            self.assertEqual('replica', self.read())
+            self.db.session.remove()
+
+    def test_writes_go_to_primary(self):
+        with self.app.test_request_context(method='POST'):
+            self.assertEqual('primary', self.read())
+            self.db.session.remove()
+        with self.app.test_request_context(method='GET'):
+            self.db.session.execute(source.update().values(name='written'))
+            self.db.session.commit()
+            self.db.session.remove()
+        with self.app.app_context():
+            # outside of requests, like background jobs
+            self.assertEqual('written', self.read())
+            self.db.session.remove()
+
+    def test_no_replica(self):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        configure_database(app.config)
+        db = RoutingSQLAlchemy(app)
+        with app.test_request_context(method='GET'):
+            self.assertEqual('primary', db.session.execute(select([source.c.name])).scalar())
+            db.session.remove()
+            db.engine.dispose()